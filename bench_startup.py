@@ -0,0 +1,66 @@
+"""Замер времени запуска: импорт main.py и инициализация БД.
+
+Запуск: python bench_startup.py [количество_повторов]
+
+Каждый замер выполняется в отдельном процессе, чтобы кэш импортов не искажал результат.
+Сравниваются:
+  - импорт main.py (без подключения к БД, PIL и qrcode);
+  - импорт PIL и qrcode, который раньше выполнялся при каждом запуске;
+  - init_db() на новой БД (полное создание схемы) и на БД с актуальной версией схемы.
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+IMPORT_MAIN = "import main"
+IMPORT_HEAVY = "import PIL.Image, qrcode"
+INIT_DB = "import main; main.init_db()"
+
+
+def run_timed(statement, env=None):
+    """Время выполнения statement в новом процессе интерпретатора, в секундах"""
+    code = f"import time; started = time.perf_counter(); {statement}; print(time.perf_counter() - started)"
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def measure(statement, runs, env=None, prepare=None):
+    timings = []
+    for _ in range(runs):
+        if prepare:
+            prepare()
+        timings.append(run_timed(statement, env))
+    return statistics.median(timings)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.sqlite")
+        env = dict(os.environ, DB_PATH=db_path)
+
+        def fresh_db():
+            if os.path.exists(db_path):
+                os.remove(db_path)
+
+        results = [
+            ("import main", measure(IMPORT_MAIN, runs, env)),
+            ("import PIL + qrcode (отложено)", measure(IMPORT_HEAVY, runs, env)),
+            ("init_db, новая БД", measure(INIT_DB, runs, env, prepare=fresh_db)),
+        ]
+        # БД после последнего прогона уже содержит актуальную версию схемы
+        results.append(("init_db, схема актуальна", measure(INIT_DB, runs, env)))
+
+    print(f"Медиана по {runs} запускам:")
+    for name, seconds in results:
+        print(f"  {name:<32} {seconds * 1000:8.1f} мс")
+
+
+if __name__ == "__main__":
+    main()
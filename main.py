@@ -10,93 +10,513 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.state import State, StatesGroup
 from aiogram import F
-from aiogram.filters import CommandStart, Command
-from aiogram.types import Message, CallbackQuery
+from aiogram.filters import CommandStart, Command, CommandObject
+from aiogram.types import Message, CallbackQuery, BufferedInputFile, InputFile
+from aiogram.types import InlineQuery, InlineQueryResultArticle, InputTextMessageContent
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram import Router
-from PIL import Image
 import base64
+import concurrent.futures
+import contextvars
+import csv
+import hashlib
+import io
 import json
 import datetime
-import qrcode # Added import for qrcode library
+import difflib
+import functools
+import heapq
+import itertools
+from collections import OrderedDict
+import time
+import zlib
 
 # === Настройки ===
 TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_IDS = [int(id.strip()) for id in os.getenv("ADMIN_ID", "").split(",") if id.strip()]
 DB_PATH = os.getenv("DB_PATH", "database.sqlite")
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "2"))
+NOTIFICATIONS_PER_SECOND = float(os.getenv("NOTIFICATIONS_PER_SECOND", "20"))
+
+# Ограничение частоты запросов: токенов в секунду и размер запаса
+THROTTLE_USER_RATE = float(os.getenv("THROTTLE_USER_RATE", "3"))
+THROTTLE_USER_BURST = int(os.getenv("THROTTLE_USER_BURST", "10"))
+THROTTLE_HANDLER_RATE = float(os.getenv("THROTTLE_HANDLER_RATE", "1"))
+THROTTLE_HANDLER_BURST = int(os.getenv("THROTTLE_HANDLER_BURST", "4"))
+
+# Журнал действий администраторов: сколько дней хранить подробные записи
+AUDIT_RETENTION_DAYS = int(os.getenv("AUDIT_RETENTION_DAYS", "365"))
+
+# Генерация изображений: число рабочих потоков и шрифт с кириллицей
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+CARD_FONT_PATH = os.getenv("CARD_FONT_PATH", "DejaVuSans.ttf")
 
 # === Логирование ===
 logging.basicConfig(level=logging.INFO)
 
 # === Инициализация бота и диспетчера ===
-bot = Bot(token=TOKEN)
+# Бот создается в create_app(); диспетчер и роутер нужны сразу для регистрации обработчиков
+bot = None
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 router = Router()
 dp.include_router(router)
 
 # === Подключение к базе данных ===
-try:
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    # Проверка подключения
-    cursor.execute("SELECT 1")
-    cursor.fetchone()
-    logging.info("Successfully connected to database")
-except sqlite3.Error as e:
-    logging.error(f"Database connection error: {e}")
-    sys.exit(1)
-
-cursor.execute('''CREATE TABLE IF NOT EXISTS points_history (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    nickname TEXT,
-    points INTEGER,
-    note TEXT,
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-)''')
-
-# Создаем таблицу events если её нет
-cursor.execute('''CREATE TABLE IF NOT EXISTS events (
-    name TEXT PRIMARY KEY,
-    content TEXT,
-    date TEXT,
-    completed INTEGER DEFAULT 0
-)''')
-
-# Создаем таблицу для хранения пригласительных ссылок
-cursor.execute('''CREATE TABLE IF NOT EXISTS user_invites (
-    user_id INTEGER PRIMARY KEY,
-    invite_link TEXT,
-    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-)''')
-
-# Создаем таблицу users если её нет
-cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-    user_id INTEGER PRIMARY KEY,
-    nickname TEXT UNIQUE,
-    real_name TEXT,
-    phone TEXT,
-    category TEXT,
-    active INTEGER DEFAULT 1,
-    points INTEGER DEFAULT 0,
-    participations INTEGER DEFAULT 0,
-    photo_path TEXT,
-    registration_date DATETIME DEFAULT CURRENT_TIMESTAMP
-)''')
-
-# Проверяем наличие колонки invited_by
-cursor.execute("PRAGMA table_info(users)")
-columns = cursor.fetchall()
-if not any(column[1] == 'invited_by' for column in columns):
-    cursor.execute('ALTER TABLE users ADD COLUMN invited_by INTEGER')
-
-# Проверяем наличие колонки registration_date
-cursor.execute("PRAGMA table_info(users)")
-columns = cursor.fetchall()
-if not any(column[1] == 'registration_date' for column in columns):
-    cursor.execute('ALTER TABLE users ADD COLUMN registration_date DATETIME')
-    cursor.execute('UPDATE users SET registration_date = CURRENT_TIMESTAMP')
-
-conn.commit()
+# Соединение открывается в init_db(), а не при импорте модуля
+conn = None
+cursor = None
+current_season_id = None
+
+# Версия схемы: при совпадении с PRAGMA user_version проверки и миграции не выполняются.
+# Увеличивается при каждом изменении ensure_schema()
+SCHEMA_VERSION = 12
+
+# Снимок мест всех пользователей одним проходом оконных функций
+RANK_SNAPSHOT_SQL = '''
+    INSERT OR REPLACE INTO rank_snapshots (day, user_id, rank, category_rank, points)
+    SELECT ?, user_id, RANK() OVER (ORDER BY points DESC),
+           RANK() OVER (PARTITION BY category ORDER BY points DESC), points
+    FROM users
+'''
+
+# Размер пачки при заполнении points_history.user_id на существующих БД
+HISTORY_BACKFILL_BATCH = 10000
+
+def backfill_user_ids(table):
+    """Заполняет user_id по никнейму пачками по id, фиксируя каждую пачку отдельно"""
+    cursor.execute(f"SELECT MIN(id), MAX(id) FROM {table} WHERE user_id IS NULL")
+    first_id, last_id = cursor.fetchone()
+    if first_id is None:
+        return
+    updated = 0
+    for start in range(first_id, last_id + 1, HISTORY_BACKFILL_BATCH):
+        cursor.execute(f'''
+            UPDATE {table} SET user_id = (SELECT u.user_id FROM users u WHERE u.nickname = {table}.nickname)
+            WHERE id >= ? AND id < ? AND user_id IS NULL
+        ''', (start, start + HISTORY_BACKFILL_BATCH))
+        updated += cursor.rowcount
+        conn.commit()
+    logging.info(f"Backfilled user_id for {updated} rows in {table}")
+
+def ensure_schema():
+    """Создает таблицы, индексы и триггеры и переносит данные со старых схем"""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS points_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        nickname TEXT,
+        points INTEGER,
+        note TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
+    # История привязывается к user_id, никнейм остается для отображения
+    cursor.execute("PRAGMA table_info(points_history)")
+    if not any(column[1] == 'user_id' for column in cursor.fetchall()):
+        cursor.execute('ALTER TABLE points_history ADD COLUMN user_id INTEGER')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_points_history_user ON points_history (user_id, timestamp)")
+
+    # Создаем таблицу events если её нет (события адресуются числовым id, дата хранится как ГГГГ-ММ-ДД ЧЧ:ММ)
+    cursor.execute("PRAGMA table_info(events)")
+    event_columns = [column[1] for column in cursor.fetchall()]
+    legacy_events = bool(event_columns) and 'id' not in event_columns
+    if legacy_events:
+        cursor.execute("ALTER TABLE events RENAME TO events_legacy")
+    cursor.execute('''CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        content TEXT,
+        date TEXT,
+        completed INTEGER DEFAULT 0
+    )''')
+    if legacy_events:
+        # Переносим события со старой схемы (name PRIMARY KEY, дата ДД.ММ.ГГГГ ЧЧ:ММ)
+        cursor.execute('''
+            INSERT INTO events (name, content, date, completed)
+            SELECT name, content,
+                   CASE WHEN date LIKE '__.__.____%'
+                        THEN substr(date, 7, 4) || '-' || substr(date, 4, 2) || '-' || substr(date, 1, 2) || substr(date, 11)
+                        ELSE date END AS iso_date,
+                   completed
+            FROM events_legacy ORDER BY iso_date
+        ''')
+        cursor.execute("DROP TABLE events_legacy")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_events_status_date ON events (completed, date DESC)")
+    cursor.execute("PRAGMA table_info(events)")
+    event_columns = [column[1] for column in cursor.fetchall()]
+    if 'starts_at' not in event_columns:
+        cursor.execute('ALTER TABLE events ADD COLUMN starts_at TEXT')
+    if 'award_points' not in event_columns:
+        cursor.execute('ALTER TABLE events ADD COLUMN award_points INTEGER DEFAULT 0')
+
+    # Отметки участников на событиях
+    cursor.execute('''CREATE TABLE IF NOT EXISTS event_checkins (
+        event_id INTEGER,
+        user_id INTEGER,
+        checked_by INTEGER,
+        checked_in_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (event_id, user_id)
+    )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_event_checkins_user ON event_checkins (user_id)")
+    # Отметки, оставшиеся от удаленных событий
+    cursor.execute("DELETE FROM event_checkins WHERE event_id NOT IN (SELECT id FROM events)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_events_name ON events (name)")
+
+    # Задачи планировщика (повторяющиеся по cron и разовые)
+    cursor.execute('''CREATE TABLE IF NOT EXISTS scheduled_jobs (
+        name TEXT PRIMARY KEY,
+        handler TEXT NOT NULL,
+        cron TEXT,
+        next_run TEXT,
+        last_run TEXT,
+        payload TEXT
+    )''')
+
+    # Создаем таблицу для хранения пригласительных ссылок
+    cursor.execute('''CREATE TABLE IF NOT EXISTS user_invites (
+        user_id INTEGER PRIMARY KEY,
+        invite_link TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+    # Создаем таблицу users если её нет
+    cursor.execute('''CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        nickname TEXT UNIQUE,
+        real_name TEXT,
+        phone TEXT,
+        category TEXT,
+        active INTEGER DEFAULT 1,
+        points INTEGER DEFAULT 0,
+        participations INTEGER DEFAULT 0,
+        photo_path TEXT,
+        registration_date DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+    # Проверяем наличие колонки invited_by
+    cursor.execute("PRAGMA table_info(users)")
+    columns = cursor.fetchall()
+    if not any(column[1] == 'invited_by' for column in columns):
+        cursor.execute('ALTER TABLE users ADD COLUMN invited_by INTEGER')
+
+    # Проверяем наличие счетчика приглашений и заполняем его один раз
+    if not any(column[1] == 'invites_count' for column in columns):
+        cursor.execute('ALTER TABLE users ADD COLUMN invites_count INTEGER DEFAULT 0')
+        cursor.execute('''
+            UPDATE users SET invites_count = (SELECT COUNT(*) FROM users i WHERE i.invited_by = users.user_id)
+        ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_invited_by ON users (invited_by)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_invites_count ON users (invites_count DESC)")
+
+    # Счетчик приглашений поддерживается триггерами при регистрации и удалении
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_invites_insert AFTER INSERT ON users
+    WHEN NEW.invited_by IS NOT NULL
+    BEGIN
+        UPDATE users SET invites_count = invites_count + 1 WHERE user_id = NEW.invited_by;
+    END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_invites_delete AFTER DELETE ON users
+    WHEN OLD.invited_by IS NOT NULL
+    BEGIN
+        UPDATE users SET invites_count = invites_count - 1 WHERE user_id = OLD.invited_by;
+    END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_invites_update AFTER UPDATE OF invited_by ON users
+    WHEN OLD.invited_by IS NOT NEW.invited_by
+    BEGIN
+        UPDATE users SET invites_count = invites_count - 1 WHERE user_id = OLD.invited_by;
+        UPDATE users SET invites_count = invites_count + 1 WHERE user_id = NEW.invited_by;
+    END''')
+
+    # Полнотекстовый индекс для поиска по никнейму и имени (триграммы: подстроки и опечатки)
+    cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS users_search USING fts5(
+        nickname, real_name, content='users', content_rowid='user_id', tokenize='trigram'
+    )''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_search_insert AFTER INSERT ON users BEGIN
+        INSERT INTO users_search (rowid, nickname, real_name) VALUES (NEW.user_id, NEW.nickname, NEW.real_name);
+    END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_search_delete AFTER DELETE ON users BEGIN
+        INSERT INTO users_search (users_search, rowid, nickname, real_name)
+        VALUES ('delete', OLD.user_id, OLD.nickname, OLD.real_name);
+    END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_search_update AFTER UPDATE OF nickname, real_name ON users BEGIN
+        INSERT INTO users_search (users_search, rowid, nickname, real_name)
+        VALUES ('delete', OLD.user_id, OLD.nickname, OLD.real_name);
+        INSERT INTO users_search (rowid, nickname, real_name) VALUES (NEW.user_id, NEW.nickname, NEW.real_name);
+    END''')
+    cursor.execute("INSERT INTO users_search (users_search) VALUES ('rebuild')")
+
+    # Временные данные регистрации до выбора категории
+    cursor.execute('''CREATE TABLE IF NOT EXISTS temp_registration (
+        user_id INTEGER PRIMARY KEY,
+        nickname TEXT,
+        real_name TEXT,
+        phone TEXT,
+        invited_by INTEGER,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
+    cursor.execute("PRAGMA table_info(temp_registration)")
+    if not any(column[1] == 'invited_by' for column in cursor.fetchall()):
+        cursor.execute('ALTER TABLE temp_registration ADD COLUMN invited_by INTEGER')
+
+    # Проверяем наличие колонки registration_date
+    cursor.execute("PRAGMA table_info(users)")
+    columns = cursor.fetchall()
+    if not any(column[1] == 'registration_date' for column in columns):
+        cursor.execute('ALTER TABLE users ADD COLUMN registration_date DATETIME')
+        cursor.execute('UPDATE users SET registration_date = CURRENT_TIMESTAMP')
+
+    # Сезоны рейтинга (открытым считается сезон без даты закрытия)
+    cursor.execute('''CREATE TABLE IF NOT EXISTS seasons (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        started_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        closed_at DATETIME
+    )''')
+    cursor.execute("SELECT id FROM seasons WHERE closed_at IS NULL ORDER BY id DESC LIMIT 1")
+    season_row = cursor.fetchone()
+    if season_row:
+        season_id = season_row[0]
+    else:
+        cursor.execute("INSERT INTO seasons (name) VALUES (?)", ("Тестовый сезон",))
+        season_id = cursor.lastrowid
+
+    # Агрегаты очков по периодам (неделя, месяц, сезон), обновляются при каждом начислении
+    cursor.execute('''CREATE TABLE IF NOT EXISTS points_rollup (
+        period TEXT,
+        period_key TEXT,
+        user_id INTEGER,
+        points INTEGER DEFAULT 0,
+        participations INTEGER DEFAULT 0,
+        PRIMARY KEY (period, period_key, user_id)
+    )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_points_rollup_board ON points_rollup (period, period_key, points DESC)")
+
+    # Индекс для рейтинга внутри категории
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_category_points ON users (category, points DESC)")
+
+    # Итоговые таблицы закрытых сезонов
+    cursor.execute('''CREATE TABLE IF NOT EXISTS season_standings (
+        season_id INTEGER,
+        user_id INTEGER,
+        nickname TEXT,
+        category TEXT,
+        rank INTEGER,
+        points INTEGER,
+        participations INTEGER,
+        PRIMARY KEY (season_id, user_id)
+    )''')
+
+    # Архив истории начислений, разбитый по сезонам
+    cursor.execute('''CREATE TABLE IF NOT EXISTS points_history_archive (
+        id INTEGER PRIMARY KEY,
+        season_id INTEGER,
+        user_id INTEGER,
+        nickname TEXT,
+        points INTEGER,
+        note TEXT,
+        timestamp DATETIME
+    )''')
+    cursor.execute("PRAGMA table_info(points_history_archive)")
+    if not any(column[1] == 'user_id' for column in cursor.fetchall()):
+        cursor.execute('ALTER TABLE points_history_archive ADD COLUMN user_id INTEGER')
+    # Архив, как и история, ищется по user_id
+    cursor.execute("DROP INDEX IF EXISTS idx_points_history_archive_season")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_points_history_archive_season_user ON points_history_archive (season_id, user_id)")
+
+    # Полнотекстовый индекс примечаний к начислениям для аудита
+    cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS history_search USING fts5(
+        note, content='points_history', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_history_search_insert AFTER INSERT ON points_history BEGIN
+        INSERT INTO history_search (rowid, note) VALUES (NEW.id, NEW.note);
+    END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_history_search_delete AFTER DELETE ON points_history BEGIN
+        INSERT INTO history_search (history_search, rowid, note) VALUES ('delete', OLD.id, OLD.note);
+    END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_history_search_update AFTER UPDATE OF note ON points_history BEGIN
+        INSERT INTO history_search (history_search, rowid, note) VALUES ('delete', OLD.id, OLD.note);
+        INSERT INTO history_search (rowid, note) VALUES (NEW.id, NEW.note);
+    END''')
+    cursor.execute("INSERT INTO history_search (history_search) VALUES ('rebuild')")
+
+    # Служебные значения (ключ - значение)
+    cursor.execute('''CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )''')
+
+    # Суммы истории начислений по пользователям до meta.reconcile_history_id
+    cursor.execute('''CREATE TABLE IF NOT EXISTS balance_checkpoints (
+        user_id INTEGER PRIMARY KEY,
+        points INTEGER DEFAULT 0,
+        participations INTEGER DEFAULT 0
+    )''')
+
+    # file_id уже отправленных сгенерированных изображений, по одному на (вид, владелец)
+    cursor.execute('''CREATE TABLE IF NOT EXISTS image_cache (
+        kind TEXT,
+        owner TEXT,
+        version TEXT,
+        file_id TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (kind, owner)
+    )''')
+
+    # Счетчики статистики, поддерживаются триггерами
+    stats_exists = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stats_counters'").fetchone()
+    cursor.execute('''CREATE TABLE IF NOT EXISTS stats_counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER DEFAULT 0
+    )''')
+    if not stats_exists:
+        cursor.execute('''
+            INSERT INTO stats_counters (name, value)
+            SELECT 'users_total', COUNT(*) FROM users
+            UNION ALL SELECT 'users_active', COUNT(*) FROM users WHERE active = 1
+            UNION ALL SELECT 'registrations', COUNT(*) FROM users
+            UNION ALL SELECT 'invited_users', COUNT(*) FROM users WHERE invited_by IS NOT NULL
+            UNION ALL SELECT 'invite_links', COUNT(*) FROM user_invites
+            UNION ALL SELECT 'awards', COUNT(*) FROM points_history
+            UNION ALL SELECT 'points_awarded', COALESCE(SUM(points), 0) FROM points_history
+        ''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_stats_users_insert AFTER INSERT ON users BEGIN
+        UPDATE stats_counters SET value = value + 1
+        WHERE name IN ('users_total', 'registrations')
+           OR (name = 'users_active' AND NEW.active = 1)
+           OR (name = 'invited_users' AND NEW.invited_by IS NOT NULL);
+    END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_stats_users_delete AFTER DELETE ON users BEGIN
+        UPDATE stats_counters SET value = value - 1
+        WHERE name = 'users_total'
+           OR (name = 'users_active' AND OLD.active = 1)
+           OR (name = 'invited_users' AND OLD.invited_by IS NOT NULL);
+    END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_stats_users_active AFTER UPDATE OF active ON users
+    WHEN OLD.active IS NOT NEW.active
+    BEGIN
+        UPDATE stats_counters SET value = value + (NEW.active = 1) - (OLD.active = 1) WHERE name = 'users_active';
+    END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_stats_invites_insert AFTER INSERT ON user_invites BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'invite_links';
+    END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_stats_invites_delete AFTER DELETE ON user_invites BEGIN
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'invite_links';
+    END''')
+    # Начисления считаются нарастающим итогом: удаление истории (сброс, закрытие сезона) их не уменьшает
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_stats_history_insert AFTER INSERT ON points_history BEGIN
+        UPDATE stats_counters SET value = value + CASE name WHEN 'awards' THEN 1 ELSE NEW.points END
+        WHERE name IN ('awards', 'points_awarded');
+    END''')
+
+    # Значения счетчиков на конец каждого дня, записываются задачей stats_rollup
+    cursor.execute('''CREATE TABLE IF NOT EXISTS stats_daily (
+        day TEXT PRIMARY KEY,
+        users_total INTEGER,
+        users_active INTEGER,
+        registrations INTEGER,
+        awards INTEGER,
+        points_awarded INTEGER
+    )''')
+    if not stats_exists:
+        # Точка отсчета для периодов на момент включения статистики
+        cursor.execute('''
+            INSERT OR IGNORE INTO stats_daily (day, users_total, users_active, registrations, awards, points_awarded)
+            SELECT date('now', 'localtime', '-1 day'),
+                   SUM(CASE name WHEN 'users_total' THEN value END), SUM(CASE name WHEN 'users_active' THEN value END),
+                   SUM(CASE name WHEN 'registrations' THEN value END), SUM(CASE name WHEN 'awards' THEN value END),
+                   SUM(CASE name WHEN 'points_awarded' THEN value END)
+            FROM stats_counters
+        ''')
+
+    # Журнал действий администраторов (только добавление, старые записи сворачиваются в помесячные итоги)
+    cursor.execute('''CREATE TABLE IF NOT EXISTS admin_audit (
+        id INTEGER PRIMARY KEY,
+        admin_id INTEGER,
+        action TEXT,
+        target TEXT,
+        details TEXT,
+        created_at TEXT
+    )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_admin_audit_admin ON admin_audit (admin_id, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_admin_audit_target ON admin_audit (target, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_admin_audit_created ON admin_audit (created_at)")
+    cursor.execute('''CREATE TABLE IF NOT EXISTS admin_audit_summary (
+        month TEXT,
+        admin_id INTEGER,
+        action TEXT,
+        count INTEGER,
+        PRIMARY KEY (month, admin_id, action)
+    )''')
+
+    # Места пользователей на конец дня для стрелок движения в рейтинге
+    snapshots_exist = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rank_snapshots'").fetchone()
+    cursor.execute('''CREATE TABLE IF NOT EXISTS rank_snapshots (
+        day TEXT,
+        user_id INTEGER,
+        rank INTEGER,
+        category_rank INTEGER,
+        points INTEGER,
+        PRIMARY KEY (day, user_id)
+    ) WITHOUT ROWID''')
+    if not snapshots_exist:
+        cursor.execute(RANK_SNAPSHOT_SQL, ((datetime.date.today() - datetime.timedelta(days=1)).isoformat(),))
+
+    # Агрегаты ниже строятся по user_id, поэтому история заполняется им заранее
+    conn.commit()
+    backfill_user_ids("points_history")
+    backfill_user_ids("points_history_archive")
+
+    # Недели раньше обозначались как %Y-%W и разрывались на границе года,
+    # теперь ключ недели - дата ее понедельника; старые строки пересчитываются из истории
+    cursor.execute("SELECT 1 FROM points_rollup WHERE period = 'week' AND period_key NOT LIKE '____-__-__' LIMIT 1")
+    rebuild_weeks = cursor.fetchone() is not None
+    if rebuild_weeks:
+        cursor.execute("DELETE FROM points_rollup WHERE period = 'week'")
+
+    # Первичное заполнение агрегатов из уже накопленной истории
+    seed_periods = (("week", "date(h.timestamp, '-6 days', 'weekday 1')"),
+                    ("month", "strftime('%Y-%m', h.timestamp)"),
+                    ("season", "?"))
+    cursor.execute("SELECT COUNT(*) FROM points_rollup")
+    if cursor.fetchone()[0] > 0:
+        seed_periods = seed_periods[:1] if rebuild_weeks else ()
+    for period, key_expr in seed_periods:
+        cursor.execute(f'''
+            INSERT INTO points_rollup (period, period_key, user_id, points, participations)
+            SELECT '{period}', {key_expr}, u.user_id, SUM(h.points), COUNT(*)
+            FROM points_history h JOIN users u ON u.user_id = h.user_id
+            GROUP BY 2, 3
+        ''', (str(season_id),) if period == "season" else ())
+
+    cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.commit()
+
+def init_db(path=None):
+    """Подключается к БД и обновляет схему, если версия в файле устарела"""
+    global conn, cursor, current_season_id
+    if conn is not None:
+        return conn
+    try:
+        conn = sqlite3.connect(path or DB_PATH)
+        cursor = conn.cursor()
+        # WAL: выгрузки и резервные копии читают БД, не блокируя запись
+        cursor.execute("PRAGMA journal_mode = WAL")
+        # Проверка подключения и версии схемы
+        cursor.execute("PRAGMA user_version")
+        schema_version = cursor.fetchone()[0]
+        logging.info("Successfully connected to database")
+    except sqlite3.Error as e:
+        logging.error(f"Database connection error: {e}")
+        sys.exit(1)
+
+    if schema_version < SCHEMA_VERSION:
+        started = time.perf_counter()
+        ensure_schema()
+        logging.info(f"Database schema updated to version {SCHEMA_VERSION} in {time.perf_counter() - started:.3f}s")
+
+    cursor.execute("SELECT id FROM seasons WHERE closed_at IS NULL ORDER BY id DESC LIMIT 1")
+    current_season_id = cursor.fetchone()[0]
+    return conn
 
 # === FSM Модель ===
 class Register(StatesGroup):
@@ -121,6 +541,9 @@ def register_user(user_id, nickname, real_name, phone, category):
         VALUES (?, ?, ?, ?, ?, datetime('now'))
     """, (user_id, nickname, real_name, phone, category))
     conn.commit()
+    invalidate_category_ranks(category)
+    invalidate_profiles(user_id)
+    search_cache.clear()
 
 def get_user(user_id):
     cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
@@ -133,37 +556,779 @@ def get_user_by_nickname(nickname):
 def update_user(user_id, field, value):
     cursor.execute(f"UPDATE users SET {field} = ? WHERE user_id = ?", (value, user_id))
     conn.commit()
+    invalidate_profiles(user_id)
+    if field in ("nickname", "real_name"):
+        search_cache.clear()
+
+# === Хранилище фото ===
+PHOTOS_DIR = "photos"
+# Файлы моложе этого возраста сборщик мусора не трогает (запись могла еще не попасть в БД)
+PHOTO_GC_GRACE = 3600
+
+class PhotoStore:
+    """Фото хранятся по sha256 содержимого в каталогах photos/ab/cd/<хэш>.jpg.
+    Одинаковые фото записываются один раз, список файлов держится в памяти"""
+
+    def __init__(self, root):
+        self.root = root
+        self.index = set()
+
+    def load(self):
+        """Читает список файлов с диска, вызывается при запуске"""
+        self.index.clear()
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith(".jpg") and not name.startswith("temp_"):
+                    self.index.add(os.path.join(directory, name))
+        logging.info(f"Photo store: {len(self.index)} files indexed")
+
+    def exists(self, path):
+        return path in self.index
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], f"{digest}.jpg")
+
+    async def put(self, data):
+        """Сохраняет фото и возвращает путь к нему; файл появляется на диске целиком (атомарное переименование)"""
+        path = self.path_for(hashlib.sha256(data).hexdigest())
+        if path in self.index:
+            return path
+
+        def write():
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+
+        await asyncio.to_thread(write)
+        self.index.add(path)
+        return path
+
+    async def collect_garbage(self, referenced):
+        """Удаляет файлы, на которые не ссылается ни один пользователь, и брошенные временные файлы"""
+        orphans = [path for path in self.index if path not in referenced]
+        self.index.difference_update(orphans)
+        root = self.root
+
+        def remove():
+            removed = 0
+            deadline = time.time() - PHOTO_GC_GRACE
+            candidates = list(orphans)
+            for directory, _, files in os.walk(root):
+                candidates.extend(os.path.join(directory, name) for name in files
+                                  if name.endswith(".tmp") or name.startswith("temp_"))
+            for path in candidates:
+                try:
+                    # Файл могли заново записать после построения списка
+                    if path in self.index or os.path.getmtime(path) > deadline:
+                        continue
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+            return removed
+
+        removed = await asyncio.to_thread(remove)
+        # Недавние файлы, которые не удалили, возвращаются в список
+        self.index.update(path for path in orphans if os.path.exists(path))
+        logging.info(f"Photo store GC: {removed} files removed")
+        return removed
+
+photo_store = PhotoStore(PHOTOS_DIR)
+
+# Ограничения на загружаемое фото профиля
+PHOTO_MAX_SIZE = 10 * 1024 * 1024
+PHOTO_MAX_WIDTH = 1080
+
+class CappedBuffer(io.BytesIO):
+    """Буфер в памяти, который прерывает скачивание при превышении лимита"""
+
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+
+    def write(self, data):
+        if self.tell() + len(data) > self.limit:
+            raise ValueError(f"File exceeds {self.limit} bytes")
+        return super().write(data)
+
+def prepare_profile_photo(data):
+    """Уменьшает фото до PHOTO_MAX_WIDTH по ширине и кодирует в JPEG. Выполняется в рабочем потоке"""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as img:
+        width, height = img.size
+        if width > height:
+            return None
+        if width > PHOTO_MAX_WIDTH:
+            img = img.resize((PHOTO_MAX_WIDTH, int(height * (PHOTO_MAX_WIDTH / width))), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        img.convert("RGB").save(buffer, format='JPEG', quality=85, optimize=True)
+    return buffer.getvalue()
+
+# === Карточки профилей ===
+PROFILE_COLUMNS = ("user_id", "nickname", "real_name", "phone", "category", "points", "participations",
+                   "photo_path", "registration_date", "invites_count")
+PROFILE_SELECT = f"SELECT {', '.join(PROFILE_COLUMNS)} FROM users"
+
+# Роли зрителя: свой профиль, администратор, остальные
+PROFILE_OWN = "own"
+PROFILE_ADMIN = "admin"
+PROFILE_PUBLIC = "public"
+
+class ProfileRecord:
+    """Данные пользователя, необходимые для карточки профиля"""
+    __slots__ = PROFILE_COLUMNS
+
+    def __init__(self, row):
+        for name, value in zip(self.__slots__, row):
+            setattr(self, name, value)
+
+class ProfileCard:
+    """Готовая карточка: текст, клавиатура и фото (файл или file_id после первой отправки)"""
+    __slots__ = ("text", "markup", "photo")
+
+    def __init__(self, text, markup, photo):
+        self.text = text
+        self.markup = markup
+        self.photo = photo
+
+# Карточки по ключу (user_id, роль, эпоха, версия данных пользователя)
+PROFILE_CACHE_SIZE = 1024
+profile_cards = OrderedDict()
+profile_versions = {}
+profile_ids = {}
+profile_epoch = 0
+
+def invalidate_profiles(*user_ids):
+    """Делает устаревшими карточки указанных пользователей, без аргументов - всех"""
+    global profile_epoch
+    if not user_ids:
+        profile_epoch += 1
+        profile_cards.clear()
+        profile_ids.clear()
+    for user_id in user_ids:
+        if user_id is not None:
+            profile_versions[user_id] = profile_versions.get(user_id, 0) + 1
+
+def load_profile(user_id=None, nickname=None):
+    if user_id is not None:
+        row = cursor.execute(f"{PROFILE_SELECT} WHERE user_id = ?", (user_id,)).fetchone()
+    else:
+        row = cursor.execute(f"{PROFILE_SELECT} WHERE nickname = ?", (nickname,)).fetchone()
+    return ProfileRecord(row) if row else None
+
+@functools.lru_cache(maxsize=PROFILE_CACHE_SIZE)
+def profile_markup(nickname, own):
+    buttons = [[InlineKeyboardButton(text="История начислений", callback_data=f"history:{nickname}")]]
+    if own:
+        buttons.append([InlineKeyboardButton(text="Обновить данные", callback_data="update_profile")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+async def render_profile(record, role):
+    if role == PROFILE_OWN:
+        text = (f"Ваш профиль:\nНикнейм: {record.nickname}\nИмя: {record.real_name}\nТелефон: {record.phone}\n"
+                f"Категория: {record.category}\nБаллы: {record.points}\nУчастий: {record.participations}\n"
+                f"Пригласил: {record.invites_count or 0}")
+    else:
+        text = (f"Профиль пользователя {record.nickname}:\nИмя: {record.real_name}\nКатегория: {record.category}\n"
+                f"Баллы: {record.points}\nУчастий: {record.participations}")
+    if role == PROFILE_ADMIN:
+        # Получаем информацию о пользователе из Telegram
+        try:
+            chat = await bot.get_chat(record.user_id)
+            username = f"@{chat.username}" if chat.username else "не указан"
+        except Exception as e:
+            logging.error(f"Error getting username: {e}")
+            username = "не указан"
+        registration_date = record.registration_date.split('.')[0].replace('T', ' ') if record.registration_date else "Не указана"
+        text += f"\n\nTelegram: {username}\nID: {record.user_id}\nДата регистрации: {registration_date}"
+
+    photo = FSInputFile(record.photo_path) if record.photo_path and photo_store.exists(record.photo_path) else None
+    return ProfileCard(text, profile_markup(record.nickname, role == PROFILE_OWN), photo)
+
+async def get_profile_card(role, user_id=None, nickname=None):
+    """Карточка профиля из кэша; БД и файловая система затрагиваются только при изменении данных"""
+    if user_id is None:
+        user_id = profile_ids.get(nickname)
+    if user_id is not None:
+        key = (user_id, role, profile_epoch, profile_versions.get(user_id, 0))
+        card = profile_cards.get(key)
+        if card:
+            profile_cards.move_to_end(key)
+            return card
+
+    record = load_profile(nickname=nickname) if nickname is not None else load_profile(user_id=user_id)
+    if not record:
+        return None
+    profile_ids[record.nickname] = record.user_id
+    key = (record.user_id, role, profile_epoch, profile_versions.get(record.user_id, 0))
+    card = await render_profile(record, role)
+    profile_cards[key] = card
+    while len(profile_cards) > PROFILE_CACHE_SIZE:
+        profile_cards.popitem(last=False)
+    return card
+
+def viewer_role(user_id):
+    return PROFILE_ADMIN if user_id in ADMIN_IDS else PROFILE_PUBLIC
+
+# === Поиск пользователей ===
+SEARCH_LIMIT = 50
+SEARCH_MIN_SIMILARITY = 0.5
+INLINE_PAGE_SIZE = 20
+INLINE_CACHE_TIME = 60
+
+# Результаты поиска по нормализованному запросу: [(user_id, nickname), ...]
+search_cache = OrderedDict()
+SEARCH_CACHE_SIZE = 512
+
+def fts_phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+def search_users(query, limit=SEARCH_LIMIT):
+    """Ищет пользователей по части никнейма или имени, при отсутствии точных совпадений - с учетом опечаток"""
+    query = " ".join(query.lower().split())
+    if not query:
+        return []
+    cached = search_cache.get(query)
+    if cached is not None:
+        search_cache.move_to_end(query)
+        return cached[:limit]
+
+    if len(query) < 3:
+        # Триграммный индекс не работает с запросами короче трех символов.
+        # LIKE в SQLite не учитывает регистр только для латиницы, поэтому проверяем и вариант с заглавной буквы
+        pattern = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        patterns = (pattern, pattern.capitalize())
+        cursor.execute(
+            "SELECT user_id, nickname FROM users WHERE nickname LIKE ? ESCAPE '\\' OR nickname LIKE ? ESCAPE '\\' "
+            "OR real_name LIKE ? ESCAPE '\\' OR real_name LIKE ? ESCAPE '\\' ORDER BY points DESC LIMIT ?",
+            (*patterns, *patterns, SEARCH_LIMIT)
+        )
+        results = cursor.fetchall()
+    else:
+        cursor.execute(
+            "SELECT rowid, nickname FROM users_search WHERE users_search MATCH ? ORDER BY rank LIMIT ?",
+            (fts_phrase(query), SEARCH_LIMIT)
+        )
+        results = cursor.fetchall()
+        if len(results) < SEARCH_LIMIT:
+            # Нечеткий поиск: кандидаты с общими триграммами, отсеянные по похожести
+            trigrams = {query[i:i + 3] for i in range(len(query) - 2)}
+            cursor.execute(
+                "SELECT rowid, nickname, real_name FROM users_search WHERE users_search MATCH ? ORDER BY rank LIMIT ?",
+                (" OR ".join(fts_phrase(t) for t in trigrams), SEARCH_LIMIT * 4)
+            )
+            found = {user_id for user_id, _ in results}
+            for user_id, nickname, real_name in cursor.fetchall():
+                if user_id in found:
+                    continue
+                similarity = max(difflib.SequenceMatcher(None, query, (value or "").lower()).ratio()
+                                 for value in (nickname, real_name))
+                if similarity >= SEARCH_MIN_SIMILARITY:
+                    results.append((user_id, nickname))
+                    if len(results) >= SEARCH_LIMIT:
+                        break
+
+    search_cache[query] = results
+    while len(search_cache) > SEARCH_CACHE_SIZE:
+        search_cache.popitem(last=False)
+    return results[:limit]
+
+async def answer_user_not_found(message, query):
+    matches = search_users(query, limit=5)
+    if matches:
+        suggestions = "\n".join(f"/профиль_{nickname}" for _, nickname in matches)
+        await message.answer(f"Пользователь не найден. Возможно, вы искали:\n{suggestions}")
+    else:
+        await message.answer("Пользователь не найден.")
+
+async def send_profile_card(message, card):
+    if card.photo:
+        sent = await message.answer_photo(photo=card.photo, caption=card.text, reply_markup=card.markup)
+        # Повторно фото отправляется по file_id без чтения файла
+        if sent.photo:
+            card.photo = sent.photo[-1].file_id
+    else:
+        sent = await message.answer(card.text, reply_markup=card.markup)
+        remember_rendered(sent, card.text, card.markup)
+
+CATEGORIES = {"1": "Юноши", "2": "Подростки", "3": "Взрослые"}
+
+RATING_PERIODS = {"week": "неделю", "month": "месяц", "season": "сезон"}
+
+def get_period_keys(moment=None):
+    """Возвращает ключи агрегатов для текущей недели, месяца и сезона"""
+    moment = moment or datetime.datetime.now(datetime.timezone.utc)
+    return {
+        "week": (moment - datetime.timedelta(days=moment.weekday())).date().isoformat(),
+        "month": moment.strftime("%Y-%m"),
+        "season": str(current_season_id)
+    }
+
+def update_points_rollup(awards):
+    """Добавляет начисления (user_id, баллы) в агрегаты всех периодов"""
+    keys = get_period_keys().items()
+    cursor.executemany("""
+        INSERT INTO points_rollup (period, period_key, user_id, points, participations)
+        VALUES (?, ?, ?, ?, 1)
+        ON CONFLICT (period, period_key, user_id)
+        DO UPDATE SET points = points + excluded.points, participations = participations + 1
+    """, [(period, key, user_id, points) for user_id, points in awards for period, key in keys])
+
+def get_period_top(period, offset=0, limit=20):
+    """Рейтинг за период по агрегатам, без группировки истории"""
+    cursor.execute("""
+        SELECT u.nickname, r.points, u.active
+        FROM points_rollup r JOIN users u ON u.user_id = r.user_id
+        WHERE r.period = ? AND r.period_key = ?
+        ORDER BY r.points DESC
+        LIMIT ? OFFSET ?
+    """, (period, get_period_keys()[period], limit, offset))
+    return cursor.fetchall()
+
+def get_period_total(period):
+    cursor.execute("SELECT COUNT(*) FROM points_rollup WHERE period = ? AND period_key = ?",
+                   (period, get_period_keys()[period]))
+    return cursor.fetchone()[0]
 
 def update_user_photo(nickname, path):
     cursor.execute("UPDATE users SET photo_path = ? WHERE nickname = ?", (path, nickname))
     conn.commit()
+    invalidate_profiles(profile_ids.get(nickname))
+
+def apply_points(awards):
+    """Начисляет баллы пачкой, awards - список (user_id, nickname, баллы, примечание).
+    Вызывается внутри транзакции, фиксирует ее вызывающий код"""
+    cursor.executemany("UPDATE users SET points = points + ?, participations = participations + 1 WHERE user_id = ?",
+                       [(points, user_id) for user_id, _, points, _ in awards])
+    cursor.executemany("INSERT INTO points_history (user_id, nickname, points, note) VALUES (?, ?, ?, ?)", awards)
+    update_points_rollup([(user_id, points) for user_id, _, points, _ in awards])
+    invalidate_profiles(*(user_id for user_id, _, _, _ in awards))
 
 async def add_points(nickname, points, note):
-    # Получаем user_id пользователя
-    cursor.execute("SELECT user_id FROM users WHERE nickname = ?", (nickname,))
+    # Получаем user_id и категорию пользователя
+    cursor.execute("SELECT user_id, category FROM users WHERE nickname = ?", (nickname,))
     result = cursor.fetchone()
     if result:
-        user_id = result[0]
+        user_id, category = result
         # Обновляем очки
-        cursor.execute("UPDATE users SET points = points + ?, participations = participations + 1 WHERE nickname = ?",
-                       (points, nickname))
-        cursor.execute("INSERT INTO points_history (nickname, points, note) VALUES (?, ?, ?)",
-                       (nickname, points, note))
-        conn.commit()
+        with conn:
+            apply_points([(user_id, nickname, points, note)])
+        invalidate_category_ranks(category)
         # Отправляем уведомление
-        try:
-            await bot.send_message(user_id, f"Вам начислено {points} баллов\nПримечание: {note}")
-        except Exception as e:
-            logging.error(f"Error sending points notification: {e}")
+        notifications.put(user_id, f"Вам начислено {points} баллов\nПримечание: {note}")
 
 def disable_user(nickname):
+    global scores_version
     cursor.execute("UPDATE users SET active = 0 WHERE nickname = ?", (nickname,))
     conn.commit()
+    scores_version += 1
 
 def get_top_users(limit=10, by="points"):
     cursor.execute(f"SELECT nickname, {by}, active FROM users ORDER BY {by} DESC LIMIT ?", (limit,))
     return cursor.fetchall()
 
+def get_category_top(category, offset=0, limit=20):
+    cursor.execute(
+        "SELECT nickname, points, active FROM users WHERE category = ? ORDER BY points DESC LIMIT ? OFFSET ?",
+        (category, limit, offset)
+    )
+    return cursor.fetchall()
+
+def get_category_total(category):
+    cursor.execute("SELECT COUNT(*) FROM users WHERE category = ?", (category,))
+    return cursor.fetchone()[0]
+
+# Кэш мест внутри категорий: {категория: {user_id: место}}
+category_rank_cache = {}
+
+# Версия очков: увеличивается при любом изменении баллов, категорий или состава пользователей
+scores_version = 0
+
+def invalidate_category_ranks(*categories):
+    """Сбрасывает кэш мест для указанных категорий, без аргументов - для всех"""
+    global scores_version
+    scores_version += 1
+    if not categories:
+        category_rank_cache.clear()
+    for category in categories:
+        category_rank_cache.pop(category, None)
+
+def get_category_rank(user_id, category):
+    """Место пользователя внутри категории, пересчитывается один раз на изменение категории"""
+    ranks = category_rank_cache.get(category)
+    if ranks is None:
+        cursor.execute(
+            "SELECT user_id, RANK() OVER (ORDER BY points DESC) FROM users WHERE category = ?",
+            (category,)
+        )
+        ranks = dict(cursor.fetchall())
+        category_rank_cache[category] = ranks
+    return ranks.get(user_id)
+
+# === Движение в рейтинге ===
+RANK_SNAPSHOT_RETENTION_DAYS = 35
+# Места из снимков: день -> {никнейм: (место, место в категории)}
+rank_snapshot_cache = {}
+
+def get_rank_snapshot(days_ago):
+    """Места на конец дня days_ago дней назад (или ближайшего более раннего снимка)"""
+    target = (datetime.date.today() - datetime.timedelta(days=days_ago)).isoformat()
+    if target not in rank_snapshot_cache:
+        cursor.execute("SELECT MAX(day) FROM rank_snapshots WHERE day <= ?", (target,))
+        day = cursor.fetchone()[0]
+        ranks = {}
+        if day:
+            cursor.execute("""
+                SELECT u.nickname, s.rank, s.category_rank
+                FROM rank_snapshots s JOIN users u ON u.user_id = s.user_id
+                WHERE s.day = ?
+            """, (day,))
+            ranks = {nickname: (rank, category_rank) for nickname, rank, category_rank in cursor.fetchall()}
+        # Держим только снимки за вчера и неделю назад
+        if len(rank_snapshot_cache) >= 2:
+            rank_snapshot_cache.clear()
+        rank_snapshot_cache[target] = ranks
+    return rank_snapshot_cache[target]
+
+def write_rank_snapshot(db, day):
+    """Записывает снимок мест через подключение db (выполняется в потоке планировщика)"""
+    written = db.execute(RANK_SNAPSHOT_SQL, (day,)).rowcount
+    cutoff = (datetime.date.fromisoformat(day) - datetime.timedelta(days=RANK_SNAPSHOT_RETENTION_DAYS)).isoformat()
+    db.execute("DELETE FROM rank_snapshots WHERE day < ?", (cutoff,))
+    logging.info(f"Rank snapshot for {day}: {written} users")
+
+def format_movement(previous, current):
+    """▲ - поднялся, ▼ - опустился; без снимка или без изменений - пусто"""
+    if previous is None or current is None or previous == current:
+        return ""
+    return f" ▲{previous - current}" if previous > current else f" ▼{current - previous}"
+
+def rank_movement(nickname, rank, days_ago=1, in_category=False):
+    previous = get_rank_snapshot(days_ago).get(nickname)
+    return format_movement(previous[1 if in_category else 0] if previous else None, rank)
+
+# === Планировщик задач ===
+# Диапазоны полей cron: минуты, часы, дни месяца, месяцы, дни недели (0 и 7 - воскресенье)
+CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+JOB_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+class CronTrigger:
+    """Расписание в формате cron: минуты, часы, дни месяца, месяцы, дни недели"""
+
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"Invalid cron expression: {expression}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse(part, low, high) for part, (low, high) in zip(parts, CRON_FIELDS)
+        )
+        if 7 in self.weekdays:
+            self.weekdays = (self.weekdays - {7}) | {0}
+        self.any_day = parts[2] == "*"
+        self.any_weekday = parts[4] == "*"
+
+    @staticmethod
+    def _parse(part, low, high):
+        values = set()
+        for item in part.split(","):
+            step = 1
+            if "/" in item:
+                item, step = item.split("/")
+                step = int(step)
+            if item == "*":
+                start, end = low, high
+            elif "-" in item:
+                start, end = map(int, item.split("-"))
+            else:
+                start = int(item)
+                end = high if step > 1 else start
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f"Invalid cron field: {part}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, moment):
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.weekday() + 1) % 7 in self.weekdays
+        # Как в cron: если заданы и день месяца, и день недели, достаточно совпадения любого
+        if self.any_day:
+            return weekday_ok
+        if self.any_weekday:
+            return day_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, moment):
+        """Ближайшее время срабатывания строго после moment"""
+        moment = moment.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = moment + datetime.timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + datetime.timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += datetime.timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"Cron expression never fires: {self.expression}")
+
+# Время, на которое был запланирован выполняемый запуск (при повторе после простоя оно в прошлом)
+scheduled_run = contextvars.ContextVar("scheduled_run", default=None)
+
+def missed_days(scheduled_for):
+    """Дни, итоги которых должен сохранить полуночный запуск scheduled_for.
+    После простоя это все дни с запланированного запуска по вчерашний: пока бот не работал, данные не менялись"""
+    first = (scheduled_for or datetime.datetime.now()).date() - datetime.timedelta(days=1)
+    last = max(datetime.date.today() - datetime.timedelta(days=1), first)
+    return [(first + datetime.timedelta(days=offset)).isoformat() for offset in range((last - first).days + 1)]
+
+class Scheduler:
+    """Асинхронный планировщик: задачи хранятся в scheduled_jobs, очередь запусков - куча по времени"""
+
+    def __init__(self, max_concurrency: int = 2):
+        self.handlers = {}
+        self.jobs = {}
+        self.heap = []
+        self.max_concurrency = max_concurrency
+        self.semaphore = None
+        self.wakeup = None
+        self.task = None
+        self.running = set()
+        self.tasks = set()
+        self._sequence = itertools.count()
+
+    def handler(self, name: str):
+        """Регистрирует корутину-обработчик задачи: async def handler(payload)"""
+        def decorator(func):
+            self.handlers[name] = func
+            return func
+        return decorator
+
+    def _push(self, job):
+        heapq.heappush(self.heap, (job["next_run"], next(self._sequence), job["name"]))
+        if self.wakeup:
+            self.wakeup.set()
+
+    def add_job(self, name, handler, cron=None, run_at=None, payload=None, replace=True):
+        """Добавляет задачу: повторяющуюся по cron или разовую на время run_at"""
+        existing = self.jobs.get(name)
+        if existing and not replace and existing["cron"] == cron:
+            return
+        trigger = CronTrigger(cron) if cron else None
+        next_run = run_at or trigger.next_after(datetime.datetime.now())
+        job = {"name": name, "handler": handler, "cron": cron, "trigger": trigger,
+               "next_run": next_run, "payload": payload}
+        self.jobs[name] = job
+        cursor.execute(
+            "INSERT OR REPLACE INTO scheduled_jobs (name, handler, cron, next_run, payload) VALUES (?, ?, ?, ?, ?)",
+            (name, handler, cron, next_run.strftime(JOB_TIME_FORMAT), json.dumps(payload) if payload else None)
+        )
+        conn.commit()
+        self._push(job)
+
+    def remove_jobs(self, prefix: str):
+        """Удаляет задачи с именами, начинающимися с prefix (записи в куче пропускаются при извлечении)"""
+        for name in [name for name in self.jobs if name.startswith(prefix)]:
+            del self.jobs[name]
+        cursor.execute("DELETE FROM scheduled_jobs WHERE substr(name, 1, ?) = ?", (len(prefix), prefix))
+        conn.commit()
+
+    def load(self):
+        """Загружает задачи из БД; пропущенные за время простоя запуски выполняются один раз сразу"""
+        cursor.execute("SELECT name, handler, cron, next_run, payload FROM scheduled_jobs")
+        for name, handler, cron, next_run, payload in cursor.fetchall():
+            try:
+                trigger = CronTrigger(cron) if cron else None
+                next_run = (datetime.datetime.strptime(next_run, JOB_TIME_FORMAT) if next_run
+                            else trigger.next_after(datetime.datetime.now()))
+            except (ValueError, AttributeError) as e:
+                logging.error(f"Skipping invalid scheduled job {name}: {e}")
+                continue
+            job = {"name": name, "handler": handler, "cron": cron, "trigger": trigger,
+                   "next_run": next_run, "payload": json.loads(payload) if payload else None}
+            self.jobs[name] = job
+            self._push(job)
+
+    def start(self, default_jobs=None):
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.wakeup = asyncio.Event()
+        self.load()
+        for name, (handler, cron) in (default_jobs or {}).items():
+            self.add_job(name, handler, cron=cron, replace=False)
+        self.task = asyncio.create_task(self._run())
+        return self.task
+
+    async def _run(self):
+        while True:
+            self.wakeup.clear()
+            now = datetime.datetime.now()
+            while self.heap and self.heap[0][0] <= now:
+                next_run, _, name = heapq.heappop(self.heap)
+                # Ошибка одной задачи не должна останавливать цикл планировщика
+                try:
+                    self._dispatch(name, next_run, now)
+                except Exception as e:
+                    logging.error(f"Scheduler failed to dispatch job {name}: {e}")
+
+            # Спим до ближайшей задачи, но не дольше минуты, чтобы не отставать при переводе часов
+            timeout = min((self.heap[0][0] - now).total_seconds(), 60) if self.heap else 60
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch(self, name, next_run, now):
+        job = self.jobs.get(name)
+        # Запись устарела: задачу удалили или перепланировали
+        if not job or job["next_run"] != next_run:
+            return
+        if job["trigger"]:
+            job["next_run"] = job["trigger"].next_after(now)
+            # Задача возвращается в кучу до записи в БД: сбой записи не теряет расписание
+            self._push(job)
+            try:
+                cursor.execute("UPDATE scheduled_jobs SET next_run = ? WHERE name = ?",
+                               (job["next_run"].strftime(JOB_TIME_FORMAT), name))
+                conn.commit()
+            except sqlite3.Error as e:
+                logging.error(f"Failed to save next run of scheduled job {name}: {e}")
+        else:
+            del self.jobs[name]
+        if name in self.running:
+            logging.warning(f"Scheduled job {name} is still running, skipping this run")
+            return
+        task = asyncio.create_task(self._execute(job, next_run))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _execute(self, job, scheduled_for):
+        name = job["name"]
+        handler = self.handlers.get(job["handler"])
+        if not handler:
+            logging.error(f"No handler {job['handler']} for scheduled job {name}")
+            return
+        self.running.add(name)
+        try:
+            async with self.semaphore:
+                started = time.perf_counter()
+                try:
+                    scheduled_run.set(scheduled_for)
+                    await handler(job["payload"])
+                    logging.info(f"Scheduled job {name} finished in {time.perf_counter() - started:.2f}s")
+                except Exception as e:
+                    logging.error(f"Scheduled job {name} failed: {e}")
+        finally:
+            self.running.discard(name)
+
+        finished_at = datetime.datetime.now().strftime(JOB_TIME_FORMAT)
+        try:
+            if job["trigger"]:
+                cursor.execute("UPDATE scheduled_jobs SET last_run = ? WHERE name = ?", (finished_at, name))
+            else:
+                # Разовая задача удаляется, если ее не перепланировали заново под тем же именем
+                cursor.execute("DELETE FROM scheduled_jobs WHERE name = ? AND next_run = ?",
+                               (name, scheduled_for.strftime(JOB_TIME_FORMAT)))
+            conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Failed to record run of scheduled job {name}: {e}")
+
+scheduler = Scheduler(max_concurrency=SCHEDULER_CONCURRENCY)
+
+class NotificationQueue:
+    """Очередь исходящих уведомлений: отправка не быстрее rate сообщений в секунду"""
+
+    def __init__(self, rate: float = 20):
+        self.interval = 1 / rate
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def put(self, user_id, text):
+        self.queue.put_nowait((user_id, text))
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+        return self.task
+
+    async def _run(self):
+        while True:
+            user_id, text = await self.queue.get()
+            try:
+                await bot.send_message(user_id, text)
+            except TelegramRetryAfter as e:
+                # Telegram просит подождать - откладываем всю очередь и повторяем сообщение
+                logging.warning(f"Notification flood limit, retrying in {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+                self.queue.put_nowait((user_id, text))
+            except Exception as e:
+                logging.error(f"Error sending notification to {user_id}: {e}")
+            await asyncio.sleep(self.interval)
+
+notifications = NotificationQueue(rate=NOTIFICATIONS_PER_SECOND)
+
+# === Журнал действий администраторов ===
+AUDIT_BATCH_SIZE = 100
+AUDIT_FLUSH_INTERVAL = 2
+
+class AuditLog:
+    """Записи копятся в памяти и пишутся в БД пачками фоновой задачей, команды не ждут записи"""
+
+    def __init__(self, batch_size=AUDIT_BATCH_SIZE, interval=AUDIT_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pending = []
+        self.wakeup = None
+        self.task = None
+
+    def record(self, admin_id, action, target=None, **details):
+        self.pending.append((
+            admin_id, action, None if target is None else str(target),
+            json.dumps(details, ensure_ascii=False, default=str) if details else None,
+            datetime.datetime.now().strftime(JOB_TIME_FORMAT)
+        ))
+        if len(self.pending) >= self.batch_size and self.wakeup:
+            self.wakeup.set()
+
+    def flush(self):
+        """Записывает накопленное одной транзакцией"""
+        if not self.pending or conn is None:
+            return 0
+        batch, self.pending = self.pending, []
+        try:
+            with conn:
+                cursor.executemany(
+                    "INSERT INTO admin_audit (admin_id, action, target, details, created_at) VALUES (?, ?, ?, ?, ?)",
+                    batch
+                )
+        except sqlite3.Error as e:
+            logging.error(f"Error writing audit log: {e}")
+            self.pending[:0] = batch
+            return 0
+        return len(batch)
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+        return self.task
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            self.flush()
+
+audit_log = AuditLog()
+
 # === Middleware для проверки личных сообщений ===
 @router.message.middleware()
 async def check_private_chat(handler, event: Message, data):
@@ -171,7 +1336,133 @@ async def check_private_chat(handler, event: Message, data):
         return
     return await handler(event, data)
 
+# === Middleware ограничения частоты запросов ===
+class RateLimiter:
+    """Корзины токенов на пользователя и на пару (пользователь, обработчик)"""
+
+    EVICT_INTERVAL = 60
+
+    def __init__(self, user_rate, user_burst, handler_rate, handler_burst):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.handler_rate = handler_rate
+        self.handler_burst = handler_burst
+        # ключ -> [токены, время последнего обновления]
+        self.buckets = {}
+        self.last_evict = time.monotonic()
+
+    def _take(self, key, rate, burst, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            self.buckets[key] = [burst - 1, now]
+            return True
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def allow(self, user_id, handler_name):
+        now = time.monotonic()
+        if now - self.last_evict > self.EVICT_INTERVAL:
+            self.evict(now)
+        if not self._take((user_id, handler_name), self.handler_rate, self.handler_burst, now):
+            return False
+        return self._take(user_id, self.user_rate, self.user_burst, now)
+
+    def evict(self, now=None):
+        """Удаляет корзины, которые за время простоя уже полностью восстановились"""
+        now = now or time.monotonic()
+        self.last_evict = now
+        idle = max(self.user_burst / self.user_rate, self.handler_burst / self.handler_rate)
+        for key in [key for key, (_, updated) in self.buckets.items() if now - updated > idle]:
+            del self.buckets[key]
+
+rate_limiter = RateLimiter(THROTTLE_USER_RATE, THROTTLE_USER_BURST, THROTTLE_HANDLER_RATE, THROTTLE_HANDLER_BURST)
+
+def handler_name(data):
+    handler_object = data.get("handler")
+    return handler_object.callback.__name__ if handler_object else "unknown"
+
+def is_throttled(user, data):
+    if not user or user.id in ADMIN_IDS:
+        return False
+    return not rate_limiter.allow(user.id, handler_name(data))
+
+@router.message.middleware()
+async def throttle_message(handler, event: Message, data):
+    if is_throttled(event.from_user, data):
+        return
+    return await handler(event, data)
+
+# === Длинные сообщения ===
+# Telegram принимает до 4096 символов, запас оставлен под хвост "... и еще N"
+MESSAGE_TEXT_LIMIT = 4000
+
+def fit_lines(header, lines, limit=MESSAGE_TEXT_LIMIT):
+    """Склеивает строки под заголовком, пока текст помещается в одно сообщение"""
+    text = header
+    for shown, line in enumerate(lines):
+        if len(text) + len(line) + 1 > limit:
+            return f"{text}... и еще {len(lines) - shown}"
+        text += f"{line}\n"
+    return text
+
+# === Пропуск правок сообщений без изменений ===
+# Хэши последнего отрисованного содержимого: (chat_id, message_id) -> хэш
+RENDERED_CACHE_SIZE = 2048
+rendered_messages = OrderedDict()
+
+def render_hash(text, reply_markup=None):
+    markup = reply_markup.model_dump_json(exclude_none=True) if reply_markup else ""
+    return hashlib.blake2b(f"{text}\0{markup}".encode("utf-8"), digest_size=16).digest()
+
+def remember_rendered(message, text, reply_markup=None):
+    """Запоминает содержимое отправленного или отредактированного сообщения"""
+    key = (message.chat.id, message.message_id)
+    rendered_messages[key] = render_hash(text, reply_markup)
+    rendered_messages.move_to_end(key)
+    while len(rendered_messages) > RENDERED_CACHE_SIZE:
+        rendered_messages.popitem(last=False)
+
+async def edit_message_text(message, text, reply_markup=None, parse_mode=None):
+    """Редактирует текст сообщения, если он или клавиатура изменились. Возвращает False, если правка не нужна"""
+    key = (message.chat.id, message.message_id)
+    if rendered_messages.get(key) == render_hash(text, reply_markup):
+        return False
+    try:
+        await message.edit_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+    remember_rendered(message, text, reply_markup)
+    return True
+
 # === Обработчики ===
+@router.message(CommandStart(deep_link=True, magic=F.args.startswith("checkin_")))
+async def scanned_check_in(message: Message, command: CommandObject):
+    """Администратор отсканировал QR участника: /start checkin_<событие>_<пользователь>"""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("Отметку участников выполняет организатор события")
+        return
+    try:
+        _, event_id, user_id = command.args.split("_")
+        event_id, user_id = int(event_id), int(user_id)
+    except ValueError:
+        await message.answer("Некорректный код отметки")
+        return
+    event = get_event(event_id)
+    user = get_user(user_id)
+    if not event or event["completed"] or not user:
+        await message.answer("Событие или участник не найдены, либо событие уже завершено")
+        return
+    if check_in(event_id, user_id, checked_by=message.from_user.id):
+        await message.answer(f"{user[1]} отмечен на событии \"{event['name']}\" ({count_checkins(event_id)} всего)")
+        notifications.put(user_id, f"Вы отмечены на событии \"{event['name']}\"")
+    else:
+        await message.answer(f"{user[1]} уже отмечен на событии \"{event['name']}\"")
+
 @router.message(CommandStart())
 async def send_welcome(message: Message):
     user = get_user(message.from_user.id)
@@ -366,37 +1657,29 @@ async def get_phone(message: Message, state: FSMContext):
     data = await state.get_data()
 
     # Получаем информацию о приглашении
+    invited_by = None
     try:
         chat_member = await bot.get_chat_member(chat_id=-1002235947486, user_id=message.from_user.id)
-        if chat_member and hasattr(chat_member, 'invite_link'):
+        invite_link = getattr(chat_member, 'invite_link', None)
+        if invite_link:
             # Находим пользователя, создавшего приглашение
-            cursor.execute("SELECT user_id FROM user_invites WHERE invite_link = ?", (chat_member.invite_link,))
+            link = getattr(invite_link, 'invite_link', invite_link)
+            cursor.execute("SELECT user_id FROM user_invites WHERE invite_link = ?", (link,))
             inviter = cursor.fetchone()
-            if inviter:
-                await state.update_data(invited_by=inviter[0])
+            if inviter and inviter[0] != message.from_user.id:
+                invited_by = inviter[0]
     except Exception as e:
         logging.error(f"Error getting invite info: {e}")
 
     # Сохраняем данные во временную таблицу
     try:
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS temp_registration (
-                user_id INTEGER PRIMARY KEY,
-                nickname TEXT,
-                real_name TEXT,
-                phone TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        conn.commit()
-
         # Очищаем старые временные данные
         cursor.execute("DELETE FROM temp_registration WHERE user_id = ?", (message.from_user.id,))
 
         # Сохраняем новые данные
         cursor.execute(
-            "INSERT INTO temp_registration (user_id, nickname, real_name, phone) VALUES (?, ?, ?, ?)",
-            (message.from_user.id, data["nickname"], data["real_name"], phone)
+            "INSERT INTO temp_registration (user_id, nickname, real_name, phone, invited_by) VALUES (?, ?, ?, ?, ?)",
+            (message.from_user.id, data["nickname"], data["real_name"], phone, invited_by)
         )
         conn.commit()
 
@@ -420,8 +1703,7 @@ async def finalize_registration(callback: CallbackQuery):
     try:
         # Получаем категорию из callback_data
         cat_id = callback.data.split(":")[1]
-        category_map = {"1": "Юноши", "2": "Подростки", "3": "Взрослые"}
-        category = category_map.get(cat_id)
+        category = CATEGORIES.get(cat_id)
 
         if not category:
             await callback.answer("Неверная категория", show_alert=True)
@@ -429,7 +1711,7 @@ async def finalize_registration(callback: CallbackQuery):
 
         # Получаем данные из временной таблицы
         cursor.execute(
-            "SELECT nickname, real_name, phone FROM temp_registration WHERE user_id = ?", 
+            "SELECT nickname, real_name, phone, invited_by FROM temp_registration WHERE user_id = ?",
             (callback.from_user.id,)
         )
         result = cursor.fetchone()
@@ -438,24 +1720,20 @@ async def finalize_registration(callback: CallbackQuery):
             await callback.answer("Данные регистрации не найдены. Пожалуйста, начните регистрацию заново.", show_alert=True)
             return
 
-        nickname, real_name, phone = result
-        category_map = {"1": "Юноши", "2": "Подростки", "3": "Взрослые"}
-        category = category_map.get(cat_id)
-
-        if not category:
-            await callback.answer("Неверная категория", show_alert=True)
-            return
-
-        # Получаем информацию о приглашении из состояния
-        data = await state.get_data()
-        invited_by = data.get('invited_by')
+        nickname, real_name, phone, invited_by = result
 
-        # Обновляем SQL запрос для сохранения информации о приглашении
+        # Счетчик приглашений пригласившего обновляется триггером
         cursor.execute("""
             INSERT INTO users (user_id, nickname, real_name, phone, category, invited_by, registration_date)
             VALUES (?, ?, ?, ?, ?, ?, datetime('now'))
         """, (callback.from_user.id, nickname, real_name, phone, category, invited_by))
+        cursor.execute("DELETE FROM temp_registration WHERE user_id = ?", (callback.from_user.id,))
         conn.commit()
+        invalidate_category_ranks(category)
+        invalidate_profiles(callback.from_user.id, invited_by)
+        search_cache.clear()
+        if invited_by:
+            invite_tree_cache.clear()
 
         buttons = [
             [KeyboardButton(text="Профиль"), KeyboardButton(text="Рейтинг")],
@@ -523,72 +1801,134 @@ async def profile(message: Message, state: FSMContext):
 
     if not viewing_own_profile:
         # Просмотр чужого профиля
-        nickname = args[1]
-        user = get_user_by_nickname(nickname)
-        if not user:
-            await message.answer("Пользователь не найден.")
+        card = await get_profile_card(viewer_role(message.from_user.id), nickname=args[1])
+        if not card:
+            await answer_user_not_found(message, " ".join(args[1:]))
             return
-        # Получаем информацию о пользователе из Telegram
-        try:
-            chat = await bot.get_chat(user[0])
-            username = f"@{chat.username}" if chat.username else "не указан"
-        except Exception as e:
-            logging.error(f"Error getting username: {e}")
-            username = "не указан"
-
-        # Форматируем дату регистрации
-        try:
-            registration_date = user[9].split('.')[0].replace('T', ' ') if user[9] else "Не указана"
-        except (IndexError, AttributeError):
-            registration_date = "Не указана"
-
-        if message.from_user.id in ADMIN_IDS:
-            profile_text = f"Профиль пользователя {nickname}:\nИмя: {user[2]}\nКатегория: {user[4]}\nБаллы: {user[6]}\nУчастий: {user[7]}\n\nTelegram: {username}\nID: {user[0]}\nДата регистрации: {registration_date}"
-        else:
-            profile_text = f"Профиль пользователя {nickname}:\nИмя: {user[2]}\nКатегория: {user[4]}\nБаллы: {user[6]}\nУчастий: {user[7]}"
     else:
         # Просмотр своего профиля
-        user = get_user(message.from_user.id)
-        if not user:
+        card = await get_profile_card(PROFILE_OWN, user_id=message.from_user.id)
+        if not card:
             await message.answer("Вы не зарегистрированы. Используйте /start.")
             return
-        invites_count = get_invites_count(message.from_user.id)
-        profile_text = f"Ваш профиль:\nНикнейм: {user[1]}\nИмя: {user[2]}\nТелефон: {user[3]}\nКатегория: {user[4]}\nБаллы: {user[6]}\nУчастий: {user[7]}\nПригласил: {invites_count}"
-
-    photo_path = user[8] if len(user) > 8 else None
-    nickname = user[1]  # Получаем никнейм из объекта user
-    buttons = [[InlineKeyboardButton(text="История начислений", callback_data=f"history:{nickname}")]]
-    if viewing_own_profile:
-        buttons.append([InlineKeyboardButton(text="Обновить данные", callback_data="update_profile")])
-    markup = InlineKeyboardMarkup(inline_keyboard=buttons)
 
-    if photo_path and os.path.exists(photo_path):
-        await message.answer_photo(photo=FSInputFile(photo_path), caption=profile_text, reply_markup=markup)
-    else:
-        await message.answer(profile_text, reply_markup=markup)
+    await send_profile_card(message, card)
 
 @router.message(F.text.regexp(r"^/профиль_.*"))
 async def profile_link(message: Message):
     nickname = message.text.replace("/профиль_", "")
-    user = get_user_by_nickname(nickname)
-    if not user:
-        await message.answer("Пользователь не найден.")
+    card = await get_profile_card(viewer_role(message.from_user.id), nickname=nickname)
+    if not card:
+        await answer_user_not_found(message, nickname)
         return
-    profile_text = f"Профиль пользователя {nickname}:\nИмя: {user[2]}\nКатегория: {user[4]}\nБаллы: {user[6]}\nУчастий: {user[7]}"
-    photo_path = user[8] if len(user) > 8 else None
-    if photo_path and os.path.exists(photo_path):
-        await message.answer_photo(photo=FSInputFile(photo_path), caption=profile_text)
+    await send_profile_card(message, card)
+
+@router.inline_query.middleware()
+async def throttle_inline(handler, event: InlineQuery, data):
+    if is_throttled(event.from_user, data):
+        return
+    return await handler(event, data)
+
+# === Рейтинг в inline-режиме ===
+LEADERBOARD_INLINE_SIZE = 10
+LEADERBOARD_CACHE_TIME = 30
+
+# Готовые результаты: категория (None - общий рейтинг) -> (версия очков, результат)
+leaderboard_results = {}
+
+def leaderboard_result(category=None):
+    """Результат inline-запроса с топом, пересобирается только после изменения очков"""
+    cached = leaderboard_results.get(category)
+    if cached and cached[0] == scores_version:
+        return cached[1]
+
+    version = scores_version
+    if category:
+        users = get_category_top(category, 0, LEADERBOARD_INLINE_SIZE)
+        title = f"Топ-{LEADERBOARD_INLINE_SIZE}: {category}"
+    else:
+        users = get_top_users(LEADERBOARD_INLINE_SIZE)
+        title = f"Топ-{LEADERBOARD_INLINE_SIZE}"
+    lines = [f"{i}. {nickname} - {points} баллов" for i, (nickname, points, _) in enumerate(users, start=1)]
+    text = f"🏆 {title}\n\n" + ("\n".join(lines) if lines else "Рейтинг пока пуст")
+    result = InlineQueryResultArticle(
+        id=f"top:{category or 'all'}:{version}",
+        title=title,
+        description=lines[0] if lines else "Рейтинг пока пуст",
+        input_message_content=InputTextMessageContent(message_text=text)
+    )
+    leaderboard_results[category] = (version, result)
+    return result
+
+@router.inline_query(F.query.regexp(r"(?i)^\s*топ(\s|$)"))
+async def inline_leaderboard(inline_query: InlineQuery):
+    """@бот топ [категория] - отправить текущий топ в любой чат"""
+    rest = inline_query.query.strip()[3:].strip().lower()
+    categories = [name for name in CATEGORIES.values() if name.lower().startswith(rest)] if rest else []
+    if categories:
+        results = [leaderboard_result(name) for name in categories]
     else:
-        await message.answer(profile_text)
+        results = [leaderboard_result()] + [leaderboard_result(name) for name in CATEGORIES.values()]
+    await inline_query.answer(results, cache_time=LEADERBOARD_CACHE_TIME, is_personal=False)
+
+@router.inline_query()
+async def inline_search(inline_query: InlineQuery):
+    """Поиск профилей через @бот <никнейм или имя> в любом чате"""
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    matches = search_users(inline_query.query)
+    results = []
+    for user_id, nickname in matches[offset:offset + INLINE_PAGE_SIZE]:
+        card = await get_profile_card(PROFILE_PUBLIC, user_id=user_id)
+        if not card:
+            continue
+        results.append(InlineQueryResultArticle(
+            id=str(user_id),
+            title=nickname,
+            description=card.text.split("\n", 1)[-1].replace("\n", ", "),
+            input_message_content=InputTextMessageContent(message_text=card.text)
+        ))
+    next_offset = str(offset + INLINE_PAGE_SIZE) if len(matches) > offset + INLINE_PAGE_SIZE else ""
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=False, next_offset=next_offset)
 
 def get_all_users(offset=0, limit=20):
     cursor.execute("SELECT nickname, points, active FROM users ORDER BY points DESC LIMIT ? OFFSET ?", (limit, offset))
     return cursor.fetchall()
 
+def get_rating_page(offset=0, limit=20, category=None):
+    """Страница рейтинга: (ник, баллы, активен, место); место с учетом равных баллов считается по всей таблице"""
+    where = "WHERE category = ?" if category else ""
+    cursor.execute(f"""
+        SELECT nickname, points, active, rank FROM (
+            SELECT nickname, points, active, RANK() OVER (ORDER BY points DESC) AS rank
+            FROM users {where}
+        ) ORDER BY rank, nickname LIMIT ? OFFSET ?
+    """, (*([category] if category else []), limit, offset))
+    return cursor.fetchall()
+
 def get_total_users():
     cursor.execute("SELECT COUNT(*) FROM users")
     return cursor.fetchone()[0]
 
+def format_rating_line(i, nickname, points, active, movement=""):
+    if active:
+        return f"{i}. <a href='/профиль {nickname}'>{nickname}</a> - {points} баллов{movement}\n"
+    return f"{i}. <s>{nickname}</s> - {points} баллов{movement}\n"
+
+def rating_period_buttons():
+    """Кнопки переключения периода рейтинга"""
+    return [
+        InlineKeyboardButton(text="Неделя", callback_data="rating_period:week:0"),
+        InlineKeyboardButton(text="Месяц", callback_data="rating_period:month:0"),
+        InlineKeyboardButton(text="Сезон", callback_data="rating_period:season:0")
+    ]
+
+def rating_category_buttons():
+    """Кнопки рейтинга по возрастным категориям"""
+    return [
+        InlineKeyboardButton(text=category, callback_data=f"rating_cat:{cat_id}:0")
+        for cat_id, category in CATEGORIES.items()
+    ]
+
 @router.message(Command(commands=["рейтинг"]))
 @router.message(F.text == "Рейтинг")
 async def show_rating(message: Message):
@@ -610,12 +1950,9 @@ async def show_rating(message: Message):
     text = "Таблица рейтинга с 🏆 Топ-10 по баллам:\n\nПосмотреть любой профиль <b>/профиль ник</b>\n\n"
 
     # Показываем топ-10
-    top_users = get_top_users()
-    for i, (nickname, points, active) in enumerate(top_users, start=1):
-        if active:
-            text += f"{i}. <a href='/профиль {nickname}'>{nickname}</a> - {points} баллов\n"
-        else:
-            text += f"{i}. <s>{nickname}</s> - {points} баллов\n"
+    top_users = get_rating_page(0, 10)
+    for i, (nickname, points, active, rank) in enumerate(top_users, start=1):
+        text += format_rating_line(i, nickname, points, active, rank_movement(nickname, rank))
 
 
     # Показываем полный список с пагинацией
@@ -636,9 +1973,12 @@ async def show_rating(message: Message):
             InlineKeyboardButton(text="←", callback_data="rating_page:prev:0"),
             InlineKeyboardButton(text="→", callback_data="rating_page:next:0")
         ])
+    keyboard.append(rating_period_buttons())
+    keyboard.append(rating_category_buttons())
 
     markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
-    await message.answer(text, reply_markup=markup, parse_mode=ParseMode.HTML)
+    sent = await message.answer(text, reply_markup=markup, parse_mode=ParseMode.HTML)
+    remember_rendered(sent, text, markup)
 
 @router.callback_query(F.data.startswith("rating_page:"))
 async def handle_rating_pagination(callback: CallbackQuery):
@@ -652,13 +1992,10 @@ async def handle_rating_pagination(callback: CallbackQuery):
     elif action == "prev" and current_page > 0:
         current_page -= 1
 
-    users = get_all_users(current_page * 20, 20)
+    users = get_rating_page(current_page * 20, 20)
     text = "📊 Полный список участников:\n\n"
-    for i, (nickname, points, active) in enumerate(users, start=current_page * 20 + 1):
-        if active:
-            text += f"{i}. <a href='/профиль {nickname}'>{nickname}</a> - {points} баллов\n"
-        else:
-            text += f"{i}. <s>{nickname}</s> - {points} баллов\n"
+    for i, (nickname, points, active, rank) in enumerate(users, start=current_page * 20 + 1):
+        text += format_rating_line(i, nickname, points, active, rank_movement(nickname, rank))
 
     keyboard = []
     if max_pages > 1:
@@ -666,9 +2003,78 @@ async def handle_rating_pagination(callback: CallbackQuery):
             InlineKeyboardButton(text="←", callback_data=f"rating_page:prev:{current_page}"),
             InlineKeyboardButton(text="→", callback_data=f"rating_page:next:{current_page}")
         ])
+    keyboard.append(rating_period_buttons())
+    keyboard.append(rating_category_buttons())
+
+    markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
+    await edit_message_text(callback.message, text, reply_markup=markup, parse_mode=ParseMode.HTML)
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("rating_period:"))
+async def handle_rating_period(callback: CallbackQuery):
+    """Рейтинг за неделю / месяц / сезон по агрегатам"""
+    _, period, page = callback.data.split(":")
+    if period not in RATING_PERIODS:
+        await callback.answer("Неизвестный период")
+        return
+    page = max(int(page), 0)
+    total = get_period_total(period)
+    max_pages = max((total - 1) // 20 + 1, 1)
+    page = min(page, max_pages - 1)
+
+    users = get_period_top(period, page * 20, 20)
+    text = f"📊 Рейтинг за {RATING_PERIODS[period]}:\n\n"
+    if not users:
+        text += "За этот период начислений пока нет.\n"
+    for i, (nickname, points, active) in enumerate(users, start=page * 20 + 1):
+        text += format_rating_line(i, nickname, points, active)
+
+    keyboard = []
+    if max_pages > 1:
+        keyboard.append([
+            InlineKeyboardButton(text="←", callback_data=f"rating_period:{period}:{max(page - 1, 0)}"),
+            InlineKeyboardButton(text="→", callback_data=f"rating_period:{period}:{min(page + 1, max_pages - 1)}")
+        ])
+    keyboard.append(rating_period_buttons())
+    keyboard.append(rating_category_buttons())
+    keyboard.append([InlineKeyboardButton(text="« Всё время", callback_data="rating_page:prev:1")])
+
+    markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
+    await edit_message_text(callback.message, text, reply_markup=markup, parse_mode=ParseMode.HTML)
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("rating_cat:"))
+async def handle_rating_category(callback: CallbackQuery):
+    """Рейтинг внутри возрастной категории с пагинацией"""
+    _, cat_id, page = callback.data.split(":")
+    category = CATEGORIES.get(cat_id)
+    if not category:
+        await callback.answer("Неверная категория")
+        return
+    total = get_category_total(category)
+    max_pages = max((total - 1) // 20 + 1, 1)
+    page = min(max(int(page), 0), max_pages - 1)
+
+    users = get_rating_page(page * 20, 20, category)
+    text = f"📊 Рейтинг категории {category}:\n\n"
+    if not users:
+        text += "В этой категории пока нет участников.\n"
+    for i, (nickname, points, active, rank) in enumerate(users, start=page * 20 + 1):
+        text += format_rating_line(i, nickname, points, active, rank_movement(nickname, rank, in_category=True))
+
+    keyboard = []
+    if max_pages > 1:
+        keyboard.append([
+            InlineKeyboardButton(text="←", callback_data=f"rating_cat:{cat_id}:{max(page - 1, 0)}"),
+            InlineKeyboardButton(text="→", callback_data=f"rating_cat:{cat_id}:{min(page + 1, max_pages - 1)}")
+        ])
+    keyboard.append(rating_period_buttons())
+    keyboard.append(rating_category_buttons())
+    keyboard.append([InlineKeyboardButton(text="« Всё время", callback_data="rating_page:prev:1")])
 
     markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
-    await callback.message.edit_text(text, reply_markup=markup, parse_mode=ParseMode.HTML)
+    await edit_message_text(callback.message, text, reply_markup=markup, parse_mode=ParseMode.HTML)
+    await callback.answer()
 
 @router.message(Command(commands=["мой_рейтинг"]))
 async def my_rating(message: Message):
@@ -682,10 +2088,244 @@ async def my_rating(message: Message):
         (message.from_user.id,)
     )
     rank = cursor.fetchone()[0]
+    category_rank = get_category_rank(user[0], user[4])
+
+    def movement(current, in_category=False):
+        changes = [f"{change.strip()} {period}" for days_ago, period in ((1, "за день"), (7, "за неделю"))
+                   if (change := rank_movement(user[1], current, days_ago, in_category))]
+        return f" ({', '.join(changes)})" if changes else ""
+
+    text = f"Ваш рейтинг:\nНикнейм: {user[1]}\nБаллы: {user[6]}\nМесто в рейтинге: {rank}{movement(rank)}"
+    if category_rank:
+        text += f"\nМесто в категории {user[4]}: {category_rank}{movement(category_rank, in_category=True)}"
+    await message.answer(text)
+
+# === Сгенерированные изображения ===
+image_pool = concurrent.futures.ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+# Рендеры в процессе: (вид, владелец, версия) -> задача, одинаковые запросы ждут один рендер
+image_renders = {}
+
+# Версия шаблона карточки входит в хэш, чтобы смена оформления сбрасывала кэш
+CARD_TEMPLATE_VERSION = 1
+CARD_SIZE = (720, 1000)
+CARD_PHOTO_HEIGHT = 720
+
+def image_version(*parts):
+    return hashlib.blake2b(json.dumps(parts, ensure_ascii=False).encode("utf-8"), digest_size=12).hexdigest()
+
+def get_cached_image(kind, owner, version):
+    cursor.execute("SELECT file_id FROM image_cache WHERE kind = ? AND owner = ? AND version = ?",
+                   (kind, str(owner), version))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def set_cached_image(kind, owner, version, file_id):
+    cursor.execute("""
+        INSERT INTO image_cache (kind, owner, version, file_id) VALUES (?, ?, ?, ?)
+        ON CONFLICT (kind, owner) DO UPDATE SET
+            version = excluded.version, file_id = excluded.file_id, created_at = CURRENT_TIMESTAMP
+    """, (kind, str(owner), version, file_id))
+    conn.commit()
 
-    await message.answer(
-        f"Ваш рейтинг:\nНикнейм: {user[1]}\nБаллы: {user[6]}\nМесто в рейтинге: {rank}"
-    )
+def render_image(kind, owner, version, render, *args):
+    """Запускает рендер в пуле потоков; повторный запрос той же версии получает ту же задачу"""
+    key = (kind, owner, version)
+    task = image_renders.get(key)
+    if task is None:
+        task = asyncio.ensure_future(asyncio.get_running_loop().run_in_executor(image_pool, render, *args))
+        image_renders[key] = task
+        task.add_done_callback(lambda _: image_renders.pop(key, None))
+    return task
+
+async def send_cached_image(message, kind, owner, version, render, *args, caption=None):
+    """Отправляет изображение по сохраненному file_id, при его отсутствии рендерит и запоминает новый"""
+    file_id = get_cached_image(kind, owner, version)
+    if file_id:
+        try:
+            await message.answer_photo(file_id, caption=caption)
+            return
+        except TelegramBadRequest as e:
+            logging.warning(f"Cached image {kind}:{owner} is no longer valid: {e}")
+
+    started = time.perf_counter()
+    data = await render_image(kind, owner, version, render, *args)
+    logging.info(f"Rendered {kind}:{owner} in {time.perf_counter() - started:.3f}s")
+    sent = await message.answer_photo(BufferedInputFile(data, filename=f"{kind}.jpg"), caption=caption)
+    set_cached_image(kind, owner, version, sent.photo[-1].file_id)
+
+def load_font(size):
+    from PIL import ImageFont
+
+    try:
+        return ImageFont.truetype(CARD_FONT_PATH, size)
+    except OSError:
+        return ImageFont.load_default(size)
+
+def render_profile_card_image(nickname, category, points, participations, rank, photo_path):
+    """Карточка профиля: фото сверху, никнейм и статистика снизу. Выполняется в пуле потоков"""
+    from PIL import Image, ImageDraw, ImageOps
+
+    width, height = CARD_SIZE
+    card = Image.new("RGB", CARD_SIZE, (24, 28, 38))
+    draw = ImageDraw.Draw(card)
+    if photo_path:
+        with Image.open(photo_path) as photo:
+            card.paste(ImageOps.fit(photo.convert("RGB"), (width, CARD_PHOTO_HEIGHT)), (0, 0))
+    else:
+        draw.rectangle((0, 0, width, CARD_PHOTO_HEIGHT), fill=(44, 52, 70))
+        initial = load_font(280)
+        draw.text((width // 2, CARD_PHOTO_HEIGHT // 2), nickname[:1].upper(), font=initial, fill=(230, 230, 230),
+                  anchor="mm")
+
+    top = CARD_PHOTO_HEIGHT + 30
+    draw.text((40, top), nickname, font=load_font(56), fill=(255, 255, 255))
+    details = f"{category}" + (f" · {rank} место" if rank else "")
+    draw.text((40, top + 80), details, font=load_font(34), fill=(190, 196, 210))
+    draw.text((40, top + 140), f"Баллы: {points}   Участий: {participations}", font=load_font(34),
+              fill=(255, 200, 80))
+
+    buffer = io.BytesIO()
+    card.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+@router.message(Command(commands=["карточка"]))
+async def profile_card_image(message: Message, command: CommandObject):
+    """/карточка [ник] - изображение с фото, категорией, баллами и местом"""
+    nickname = (command.args or "").strip()
+    record = load_profile(nickname=nickname) if nickname else load_profile(user_id=message.from_user.id)
+    if not record:
+        await message.answer("Пользователь не найден." if nickname else "Вы не зарегистрированы. Используйте /start.")
+        return
+
+    rank = get_category_rank(record.user_id, record.category)
+    photo_path = record.photo_path if record.photo_path and photo_store.exists(record.photo_path) else None
+    args = (record.nickname, record.category, record.points, record.participations, rank, photo_path)
+    version = image_version(CARD_TEMPLATE_VERSION, *args)
+    await send_cached_image(message, "card", record.user_id, version, render_profile_card_image, *args)
+
+# === Рейтинг картинкой ===
+LEADERBOARD_IMAGE_SIZE = 10
+LEADERBOARD_TEMPLATE_VERSION = 1
+# Не чаще одного рендера за этот интервал: серия начислений дает одну перерисовку
+LEADERBOARD_IMAGE_DEBOUNCE = 30
+
+class LeaderboardSnapshot:
+    """Последний рендер рейтинга: версия очков, хэш содержимого, file_id или еще не отправленные байты"""
+    __slots__ = ("version", "digest", "file_id", "data", "rendered_at")
+
+    def __init__(self, version, digest, file_id, data, rendered_at):
+        self.version = version
+        self.digest = digest
+        self.file_id = file_id
+        self.data = data
+        self.rendered_at = rendered_at
+
+# Категория (None - общий рейтинг) -> снимок и отложенное обновление
+leaderboard_snapshots = {}
+leaderboard_refreshes = {}
+
+def render_leaderboard_image(title, rows):
+    """Таблица топа: место, никнейм, баллы. Выполняется в пуле потоков"""
+    from PIL import Image, ImageDraw
+
+    width, row_height, top = 720, 64, 130
+    image = Image.new("RGB", (width, top + row_height * max(len(rows), 1) + 40), (24, 28, 38))
+    draw = ImageDraw.Draw(image)
+    draw.text((40, 40), title, font=load_font(48), fill=(255, 255, 255))
+    medals = {1: (255, 200, 80), 2: (200, 205, 215), 3: (205, 140, 90)}
+    font = load_font(34)
+    if not rows:
+        draw.text((40, top), "Рейтинг пока пуст", font=font, fill=(190, 196, 210))
+    for i, (nickname, points, active) in enumerate(rows, start=1):
+        y = top + row_height * (i - 1)
+        if i % 2:
+            draw.rectangle((20, y - 8, width - 20, y + row_height - 16), fill=(32, 38, 52))
+        color = medals.get(i, (255, 255, 255)) if active else (110, 116, 130)
+        draw.text((40, y), f"{i}.", font=font, fill=color)
+        draw.text((110, y), nickname, font=font, fill=color)
+        draw.text((width - 40, y), str(points), font=font, fill=color, anchor="ra")
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+def leaderboard_board(category=None):
+    """Заголовок и строки топа для картинки"""
+    if category:
+        rows = get_category_top(category, 0, LEADERBOARD_IMAGE_SIZE)
+        title = f"Топ-{LEADERBOARD_IMAGE_SIZE}: {category}"
+    else:
+        rows = get_top_users(LEADERBOARD_IMAGE_SIZE)
+        title = f"Топ-{LEADERBOARD_IMAGE_SIZE}"
+    return title, [tuple(row) for row in rows]
+
+async def refresh_leaderboard_snapshot(category=None):
+    version = scores_version
+    title, rows = leaderboard_board(category)
+    digest = image_version(LEADERBOARD_TEMPLATE_VERSION, title, rows)
+    owner = category or "all"
+
+    snapshot = leaderboard_snapshots.get(category)
+    if snapshot and snapshot.digest == digest:
+        # Очки менялись, но топ выглядит так же - перерисовывать нечего
+        snapshot.version = version
+        snapshot.rendered_at = time.monotonic()
+        return snapshot
+
+    file_id = get_cached_image("leaderboard", owner, digest)
+    data = None if file_id else await render_image("leaderboard", owner, digest, render_leaderboard_image, title, rows)
+    snapshot = LeaderboardSnapshot(version, digest, file_id, data, time.monotonic())
+    leaderboard_snapshots[category] = snapshot
+    return snapshot
+
+def schedule_leaderboard_refresh(category, delay):
+    task = leaderboard_refreshes.get(category)
+    if task and not task.done():
+        return
+
+    async def refresh_later():
+        await asyncio.sleep(delay)
+        await refresh_leaderboard_snapshot(category)
+
+    leaderboard_refreshes[category] = asyncio.create_task(refresh_later())
+
+async def get_leaderboard_snapshot(category=None):
+    """Снимок рейтинга; после изменения очков перерисовывается не чаще раза в LEADERBOARD_IMAGE_DEBOUNCE секунд"""
+    snapshot = leaderboard_snapshots.get(category)
+    if snapshot and snapshot.version == scores_version:
+        return snapshot
+    if snapshot:
+        age = time.monotonic() - snapshot.rendered_at
+        if age < LEADERBOARD_IMAGE_DEBOUNCE:
+            # Пока идет серия начислений, отдаем предыдущий снимок
+            schedule_leaderboard_refresh(category, LEADERBOARD_IMAGE_DEBOUNCE - age)
+            return snapshot
+    return await refresh_leaderboard_snapshot(category)
+
+@router.message(Command(commands=["топ_картинка"]))
+async def leaderboard_image(message: Message, command: CommandObject):
+    """/топ_картинка [категория] - топ в виде изображения"""
+    query = (command.args or "").strip().lower()
+    category = next((name for name in CATEGORIES.values() if query and name.lower().startswith(query)), None)
+    if query and not category:
+        await message.answer(f"Неизвестная категория. Доступны: {', '.join(CATEGORIES.values())}")
+        return
+
+    snapshot = await get_leaderboard_snapshot(category)
+    if snapshot.file_id:
+        try:
+            await message.answer_photo(snapshot.file_id)
+            return
+        except TelegramBadRequest as e:
+            logging.warning(f"Cached leaderboard image is no longer valid: {e}")
+            snapshot = await refresh_leaderboard_snapshot(category)
+            if not snapshot.data:
+                snapshot.data = await render_image("leaderboard", category or "all", snapshot.digest,
+                                                   render_leaderboard_image, *leaderboard_board(category))
+    sent = await message.answer_photo(BufferedInputFile(snapshot.data, filename="leaderboard.jpg"))
+    snapshot.file_id = sent.photo[-1].file_id
+    snapshot.data = None
+    set_cached_image("leaderboard", category or "all", snapshot.digest, snapshot.file_id)
 
 @router.message(F.text == "Информация")
 async def info(message: Message):
@@ -699,53 +2339,210 @@ async def info(message: Message):
         "-\nПожалуйста, пишите об ошибках в боте или о своих идеях! Рассмотрим все!"
     )
 
-def load_events():
-    """Загружает события из БД"""
-    cursor.execute("SELECT name, content, date, completed FROM events")
-    events = {}
-    for name, content, date, completed in cursor.fetchall():
-        events[name] = {
-            "content": content,
-            "date": date,
-            "completed": bool(completed)
-        }
-    return events
+EVENTS_PAGE_SIZE = 10
+# Фильтры списка событий: ключ в callback_data -> значение events.completed
+EVENT_FILTERS = {"all": None, "active": 0, "done": 1}
+
+# Небольшой кэш событий по id со сквозной записью
+EVENT_CACHE_SIZE = 64
+event_cache = OrderedDict()
+
+def cache_event(event):
+    event_cache[event["id"]] = event
+    event_cache.move_to_end(event["id"])
+    while len(event_cache) > EVENT_CACHE_SIZE:
+        event_cache.popitem(last=False)
+
+def format_event_date(date):
+    """Переводит дату из ГГГГ-ММ-ДД ЧЧ:ММ в ДД.ММ.ГГГГ ЧЧ:ММ для отображения"""
+    try:
+        return datetime.datetime.strptime(date, "%Y-%m-%d %H:%M").strftime("%d.%m.%Y %H:%M")
+    except (TypeError, ValueError):
+        return date or ""
+
+def get_event(event_id):
+    """Возвращает событие по id, сначала из кэша"""
+    if event_id in event_cache:
+        event_cache.move_to_end(event_id)
+        return event_cache[event_id]
+    cursor.execute("SELECT id, name, content, date, completed, starts_at, award_points FROM events WHERE id = ?",
+                   (event_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    event = {"id": row[0], "name": row[1], "content": row[2], "date": row[3], "completed": bool(row[4]),
+             "starts_at": row[5], "award_points": row[6] or 0}
+    cache_event(event)
+    return event
+
+def find_events_by_name(name):
+    cursor.execute("SELECT id FROM events WHERE name = ? ORDER BY id DESC", (name,))
+    return [row[0] for row in cursor.fetchall()]
+
+def get_events_page(status_filter="all", offset=0, limit=EVENTS_PAGE_SIZE):
+    """Страница списка событий: сначала активные, внутри статуса - от новых к старым"""
+    completed = EVENT_FILTERS[status_filter]
+    if completed is None:
+        cursor.execute(
+            "SELECT id, name, date, completed FROM events ORDER BY completed, date DESC LIMIT ? OFFSET ?",
+            (limit, offset)
+        )
+    else:
+        cursor.execute(
+            "SELECT id, name, date, completed FROM events WHERE completed = ? ORDER BY date DESC LIMIT ? OFFSET ?",
+            (completed, limit, offset)
+        )
+    return cursor.fetchall()
+
+def count_events(status_filter="all"):
+    completed = EVENT_FILTERS[status_filter]
+    if completed is None:
+        cursor.execute("SELECT COUNT(*) FROM events")
+    else:
+        cursor.execute("SELECT COUNT(*) FROM events WHERE completed = ?", (completed,))
+    return cursor.fetchone()[0]
 
 def save_event(name, content):
-    """Сохраняет событие в БД"""
-    cursor.execute(
-        "INSERT INTO events (name, content, date) VALUES (?, ?, ?)",
-        (name, content, datetime.datetime.now().strftime("%d.%m.%Y %H:%M"))
-    )
+    """Сохраняет событие в БД и возвращает его id"""
+    date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
+    cursor.execute("INSERT INTO events (name, content, date) VALUES (?, ?, ?)", (name, content, date))
     conn.commit()
+    event_id = cursor.lastrowid
+    cache_event({"id": event_id, "name": name, "content": content, "date": date, "completed": False,
+                 "starts_at": None, "award_points": 0})
+    return event_id
+
+def delete_event_db(event_id):
+    """Удаляет событие из БД вместе с отметками участников"""
+    with conn:
+        cursor.execute("DELETE FROM event_checkins WHERE event_id = ?", (event_id,))
+        cursor.execute("DELETE FROM events WHERE id = ?", (event_id,))
+    event_cache.pop(event_id, None)
+    scheduler.remove_jobs(f"event_reminder:{event_id}:")
+
+def complete_event_db(event_id):
+    """Отмечает событие как завершенное и одной транзакцией начисляет баллы всем отметившимся.
+    Возвращает список начислений (user_id, nickname, баллы, примечание)"""
+    event = get_event(event_id)
+    awards = []
+    with conn:
+        cursor.execute("UPDATE events SET completed = 1 WHERE id = ? AND completed = 0", (event_id,))
+        if cursor.rowcount and event["award_points"]:
+            cursor.execute("""
+                SELECT u.user_id, u.nickname
+                FROM event_checkins c JOIN users u ON u.user_id = c.user_id
+                WHERE c.event_id = ? AND u.active = 1
+            """, (event_id,))
+            note = f"Участие в событии \"{event['name']}\""
+            awards = [(user_id, nickname, event["award_points"], note) for user_id, nickname in cursor.fetchall()]
+            apply_points(awards)
+    if event_id in event_cache:
+        event_cache[event_id]["completed"] = True
+    scheduler.remove_jobs(f"event_reminder:{event_id}:")
+    if awards:
+        invalidate_category_ranks()
+    return awards
+
+def set_event_award(event_id, points):
+    cursor.execute("UPDATE events SET award_points = ? WHERE id = ?", (points, event_id))
+    conn.commit()
+    if event_id in event_cache:
+        event_cache[event_id]["award_points"] = points
 
-def delete_event_db(name):
-    """Удаляет событие из БД"""
-    cursor.execute("DELETE FROM events WHERE name = ?", (name,))
+def check_in(event_id, user_id, checked_by=None):
+    """Отмечает участника на событии; возвращает False, если отметка уже есть"""
+    cursor.execute("INSERT OR IGNORE INTO event_checkins (event_id, user_id, checked_by) VALUES (?, ?, ?)",
+                   (event_id, user_id, checked_by))
     conn.commit()
+    return cursor.rowcount > 0
+
+def count_checkins(event_id):
+    cursor.execute("SELECT COUNT(*) FROM event_checkins WHERE event_id = ?", (event_id,))
+    return cursor.fetchone()[0]
+
+def is_checked_in(event_id, user_id):
+    cursor.execute("SELECT 1 FROM event_checkins WHERE event_id = ? AND user_id = ?", (event_id, user_id))
+    return cursor.fetchone() is not None
 
-def complete_event_db(name):
-    """Отмечает событие как завершенное"""
-    cursor.execute("UPDATE events SET completed = 1 WHERE name = ?", (name,))
+# За сколько часов до начала события напоминать участникам
+EVENT_REMINDER_HOURS = (24, 1)
+
+def set_event_start(event_id, starts_at):
+    """Задает время начала события и перепланирует напоминания"""
+    cursor.execute("UPDATE events SET starts_at = ? WHERE id = ?", (starts_at.strftime("%Y-%m-%d %H:%M"), event_id))
     conn.commit()
+    event_cache.pop(event_id, None)
+
+    scheduler.remove_jobs(f"event_reminder:{event_id}:")
+    now = datetime.datetime.now()
+    scheduled = 0
+    for hours in EVENT_REMINDER_HOURS:
+        run_at = starts_at - datetime.timedelta(hours=hours)
+        if run_at > now:
+            scheduler.add_job(f"event_reminder:{event_id}:{hours}", "event_reminder", run_at=run_at,
+                              payload={"event_id": event_id, "hours": hours})
+            scheduled += 1
+    return scheduled
+
+@scheduler.handler("event_reminder")
+async def send_event_reminder(payload):
+    """Рассылает активным пользователям напоминание о предстоящем событии"""
+    event = get_event(payload["event_id"])
+    if not event or event["completed"]:
+        return
+    user_ids = await run_in_db_thread(
+        lambda db: [user_id for (user_id,) in db.execute("SELECT user_id FROM users WHERE active = 1")])
+    text = (f"Напоминание: через {payload['hours']} ч. начнется событие \"{event['name']}\"\n"
+            f"Начало: {format_event_date(event['starts_at'])}")
+    for user_id in user_ids:
+        notifications.put(user_id, text)
+
+def render_events_page(status_filter="all", page=0):
+    """Текст и клавиатура страницы списка событий"""
+    total = count_events(status_filter)
+    max_pages = max((total - 1) // EVENTS_PAGE_SIZE + 1, 1)
+    page = min(max(page, 0), max_pages - 1)
 
-# ЗаЗагружаем события при запуске
-EVENTS = load_events()
+    buttons = []
+    for event_id, name, date, completed in get_events_page(status_filter, page * EVENTS_PAGE_SIZE):
+        status_prefix = "✅ Завершено - " if completed else "⚡️ Активное - "
+        display_name = f"{status_prefix}{name[:40]} ({format_event_date(date).split()[0]})"
+        buttons.append([InlineKeyboardButton(text=display_name, callback_data=f"event:{event_id}")])
+
+    if max_pages > 1:
+        buttons.append([
+            InlineKeyboardButton(text="←", callback_data=f"events:{status_filter}:{max(page - 1, 0)}"),
+            InlineKeyboardButton(text=f"{page + 1}/{max_pages}", callback_data=f"events:{status_filter}:{page}"),
+            InlineKeyboardButton(text="→", callback_data=f"events:{status_filter}:{min(page + 1, max_pages - 1)}")
+        ])
+    buttons.append([
+        InlineKeyboardButton(text="Активные", callback_data="events:active:0"),
+        InlineKeyboardButton(text="Завершенные", callback_data="events:done:0"),
+        InlineKeyboardButton(text="Все", callback_data="events:all:0")
+    ])
+
+    text = "Выберите событие:" if total else "Нет событий"
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons)
 
 @router.message(F.text == "Ближайшие события")
 async def show_events(message: Message):
-    if not EVENTS:
+    if not count_events():
         await message.answer("Нет предстоящих событий")
         return
 
-    buttons = []
-    for event_name, event_data in EVENTS.items():
-        date = event_data['date'].split()[0]  # Get only the date part
-        status_prefix = "✅ Завершено - " if event_data["completed"] else "⚡️ Активное - "
-        display_name = f"{status_prefix}{event_name} ({date})"
-        buttons.append([InlineKeyboardButton(text=display_name, callback_data=f"event:{event_name}")])
-    markup = InlineKeyboardMarkup(inline_keyboard=buttons)
-    await message.answer("Выберите событие:", reply_markup=markup)
+    text, markup = render_events_page()
+    sent = await message.answer(text, reply_markup=markup)
+    remember_rendered(sent, text, markup)
+
+@router.callback_query(F.data.startswith("events:"))
+async def events_page(callback: CallbackQuery):
+    _, status_filter, page = callback.data.split(":")
+    if status_filter not in EVENT_FILTERS:
+        await callback.answer()
+        return
+    text, markup = render_events_page(status_filter, int(page))
+    await edit_message_text(callback.message, text, reply_markup=markup)
+    await callback.answer()
 
 @router.callback_query.middleware()
 async def check_private_chat_callback(handler, event: CallbackQuery, data):
@@ -753,27 +2550,80 @@ async def check_private_chat_callback(handler, event: CallbackQuery, data):
         return
     return await handler(event, data)
 
-@router.callback_query(F.data.startswith("event:"))
-async def show_event_details(callback: CallbackQuery):
-    event_name = callback.data.split(":")[1]
-    if event_name in EVENTS:
-        event_data = EVENTS[event_name]
-        status = "Завершено" if event_data["completed"] else "Активное"
+# Нажатия, которые сейчас обрабатываются: (chat_id, message_id, callback_data)
+inflight_callbacks = set()
+
+@router.callback_query.middleware()
+async def coalesce_callback(handler, event: CallbackQuery, data):
+    """Повторное нажатие той же кнопки, пока первое еще обрабатывается, только подтверждается"""
+    key = (event.message.chat.id, event.message.message_id, event.data)
+    if key in inflight_callbacks:
+        await event.answer()
+        return
+    inflight_callbacks.add(key)
+    try:
+        return await handler(event, data)
+    finally:
+        inflight_callbacks.discard(key)
 
-        buttons = []
-        if callback.from_user.id in ADMIN_IDS and not event_data["completed"]:
-            buttons.append([InlineKeyboardButton(text="Завершить", callback_data=f"complete_event:{event_name}")])
-        buttons.append([InlineKeyboardButton(text="« Назад", callback_data="back_to_events")])
+@router.callback_query.middleware()
+async def throttle_callback(handler, event: CallbackQuery, data):
+    if is_throttled(event.from_user, data):
+        await event.answer("Слишком много нажатий, подождите немного")
+        return
+    return await handler(event, data)
 
-        markup = InlineKeyboardMarkup(inline_keyboard=buttons)
-        await callback.message.edit_text(
-            f"{event_name}\n\nСтатус: {status}\nОт: {event_data['date']}\nСодержание:\n\n{event_data['content']}",
-            reply_markup=markup
-        )
+def parse_event_id(callback_data):
+    try:
+        return int(callback_data.split(":")[1])
+    except (IndexError, ValueError):
+        return None
+
+def render_event_details(event_data, viewer_id):
+    """Текст и клавиатура карточки события для пользователя viewer_id"""
+    event_id = event_data["id"]
+    status = "Завершено" if event_data["completed"] else "Активное"
+
+    buttons = []
+    if not event_data["completed"]:
+        if is_checked_in(event_id, viewer_id):
+            buttons.append([InlineKeyboardButton(text="✅ Вы отмечены", callback_data=f"checkin:{event_id}")])
+        else:
+            buttons.append([
+                InlineKeyboardButton(text="✋ Отметиться", callback_data=f"checkin:{event_id}"),
+                InlineKeyboardButton(text="QR для отметки", callback_data=f"checkin_qr:{event_id}")
+            ])
+    if viewer_id in ADMIN_IDS and not event_data["completed"]:
+        buttons.append([InlineKeyboardButton(text="Завершить", callback_data=f"complete_event:{event_id}")])
+    buttons.append([InlineKeyboardButton(text="« Назад", callback_data="back_to_events")])
+
+    markup = InlineKeyboardMarkup(inline_keyboard=buttons)
+    starts_at = f"Начало: {format_event_date(event_data['starts_at'])}\n" if event_data["starts_at"] else ""
+    award = f"Баллы за участие: {event_data['award_points']}\n" if event_data["award_points"] else ""
+    checkins = f"Отметились: {count_checkins(event_id)}\n" if viewer_id in ADMIN_IDS else ""
+    text = (f"{event_data['name']}\n\nСтатус: {status}\nОт: {format_event_date(event_data['date'])}\n{starts_at}"
+            f"{award}{checkins}Содержание:\n\n{event_data['content']}")
+    return text, markup
+
+async def refresh_event_details(callback: CallbackQuery, event_id):
+    event_data = get_event(event_id)
+    text, markup = render_event_details(event_data, callback.from_user.id)
+    await edit_message_text(callback.message, text, reply_markup=markup)
+
+@router.callback_query(F.data.startswith("event:"))
+async def show_event_details(callback: CallbackQuery):
+    event_id = parse_event_id(callback.data)
+    if event_id is None or not get_event(event_id):
+        await callback.answer("Событие не найдено")
+        return
+    await refresh_event_details(callback, event_id)
+    await callback.answer()
 
 @router.callback_query(F.data == "back_to_events")
 async def back_to_events_list(callback: CallbackQuery):
-    await show_events(callback.message)
+    text, markup = render_events_page()
+    await edit_message_text(callback.message, text, reply_markup=markup)
+    await callback.answer()
 
 @router.callback_query(F.data.startswith("complete_event:"))
 async def complete_event(callback: CallbackQuery):
@@ -781,12 +2631,90 @@ async def complete_event(callback: CallbackQuery):
         await callback.answer("Недостаточно прав")
         return
 
-    event_name = callback.data.split(":")[1]
-    if event_name in EVENTS:
-        EVENTS[event_name]["completed"] = True
-        complete_event_db(event_name)
-        await show_event_details(callback)
-        await callback.answer("Событие помечено как завершенное")
+    event_id = parse_event_id(callback.data)
+    event = get_event(event_id) if event_id is not None else None
+    if event and not event["completed"]:
+        awards = complete_event_db(event_id)
+        audit_log.record(callback.from_user.id, "завершить_событие", f"event:{event_id}", awarded=len(awards))
+        for user_id, _, points, note in awards:
+            notifications.put(user_id, f"Вам начислено {points} баллов\nПримечание: {note}")
+        await refresh_event_details(callback, event_id)
+        if awards:
+            await callback.answer(f"Событие завершено, начислено {len(awards)} участникам", show_alert=True)
+        else:
+            await callback.answer("Событие помечено как завершенное")
+    else:
+        await callback.answer()
+
+@router.callback_query(F.data.startswith("checkin:"))
+async def self_check_in(callback: CallbackQuery):
+    event_id = parse_event_id(callback.data)
+    event = get_event(event_id) if event_id is not None else None
+    if not event or event["completed"]:
+        await callback.answer("Отметка на это событие закрыта")
+        return
+    if not get_user(callback.from_user.id):
+        await callback.answer("Сначала зарегистрируйтесь", show_alert=True)
+        return
+    if check_in(event_id, callback.from_user.id):
+        await refresh_event_details(callback, event_id)
+        await callback.answer("Вы отмечены на событии")
+    else:
+        await callback.answer("Вы уже отмечены")
+
+# Имя бота для ссылок, запрашивается у Telegram один раз
+bot_username = None
+
+async def get_bot_username():
+    global bot_username
+    if bot_username is None:
+        bot_username = (await bot.get_me()).username
+    return bot_username
+
+@router.callback_query(F.data.startswith("checkin_qr:"))
+async def check_in_qr(callback: CallbackQuery):
+    """QR-код участника: администратор сканирует его и отмечает участника на событии"""
+    event_id = parse_event_id(callback.data)
+    event = get_event(event_id) if event_id is not None else None
+    if not event or event["completed"] or not get_user(callback.from_user.id):
+        await callback.answer("Отметка недоступна")
+        return
+    link = f"https://t.me/{await get_bot_username()}?start=checkin_{event_id}_{callback.from_user.id}"
+    import qrcode
+
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(link)
+    qr.make(fit=True)
+    buffer = io.BytesIO()
+    qr.make_image(fill_color="black", back_color="white").save(buffer)
+    await callback.message.answer_photo(
+        BufferedInputFile(buffer.getvalue(), filename=f"checkin_{event_id}.png"),
+        caption=f"Покажите этот код организатору события \"{event['name']}\""
+    )
+    await callback.answer()
+
+@router.message(Command(commands=["баллы_события"]))
+async def set_event_award_command(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    args = message.text.split()
+    if len(args) < 3:
+        await message.answer("Используйте: /баллы_события <id> <баллы>")
+        return
+    try:
+        event_id, points = int(args[1]), int(args[2])
+    except ValueError:
+        await message.answer("Укажите id события и количество баллов числами")
+        return
+    event = get_event(event_id)
+    if not event:
+        await message.answer("Событие не найдено")
+        return
+    set_event_award(event_id, points)
+    audit_log.record(message.from_user.id, "баллы_события", f"event:{event_id}", points=points)
+    await message.answer(
+        f"За участие в событии \"{event['name']}\" будет начислено {points} баллов каждому отметившемуся"
+    )
 
 @router.message(Command(commands=["событие"]))
 async def add_event(message: Message, state: FSMContext):
@@ -799,7 +2727,7 @@ async def add_event(message: Message, state: FSMContext):
         return
 
     event_name = args[1]
-    await state.update_data(eventname=event_name)
+    await state.update_data(event_name=event_name)
     await state.set_state(EventCreation.content)
     await message.answer(f"Введите содержание события \"{event_name}\":")
 
@@ -810,16 +2738,544 @@ async def add_event_content(message: Message, state: FSMContext):
 
     data = await state.get_data()
     event_name = data.get("event_name")
-    save_event(event_name, message.text)
-    EVENTS[event_name] = {
-        "content": message.text,
-        "date": datetime.datetime.now().strftime("%d.%m.%Y %H:%M"),
-        "completed": False
-    }
+    event_id = save_event(event_name, message.text)
+    audit_log.record(message.from_user.id, "событие", f"event:{event_id}", name=event_name)
 
-    await message.answer(f"Событие \"{event_name}\" успешно создано!")
+    await message.answer(f"Событие \"{event_name}\" (id {event_id}) успешно создано!")
     await state.clear()
 
+@router.message(Command(commands=["дата_события"]))
+async def set_event_date_command(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    args = message.text.split()
+    if len(args) < 4:
+        await message.answer("Используйте: /дата_события <id> <ДД.ММ.ГГГГ> <ЧЧ:ММ>")
+        return
+    try:
+        event_id = int(args[1])
+        starts_at = datetime.datetime.strptime(f"{args[2]} {args[3]}", "%d.%m.%Y %H:%M")
+    except ValueError:
+        await message.answer("Укажите id события и дату в формате ДД.ММ.ГГГГ ЧЧ:ММ")
+        return
+    event = get_event(event_id)
+    if not event:
+        await message.answer("Событие не найдено")
+        return
+    reminders = set_event_start(event_id, starts_at)
+    audit_log.record(message.from_user.id, "дата_события", f"event:{event_id}", starts_at=starts_at)
+    await message.answer(
+        f"Начало события \"{event['name']}\": {starts_at.strftime('%d.%m.%Y %H:%M')}\n"
+        f"Запланировано напоминаний: {reminders}"
+    )
+
+# === Аудит начислений ===
+AUDIT_PAGE_SIZE = 20
+
+# Тексты запросов аудита по короткому ключу (в callback_data помещается только ключ)
+audit_queries = OrderedDict()
+AUDIT_QUERIES_SIZE = 256
+
+def audit_match_query(text):
+    """Запрос FTS5: все слова должны встречаться в примечании, каждое ищется по началу слова"""
+    words = text.split()
+    return " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+
+def search_history_notes(text, offset=0, limit=AUDIT_PAGE_SIZE):
+    """Суммы баллов по пользователям для начислений, в примечании которых есть слова из text"""
+    match = audit_match_query(text)
+    cursor.execute("""
+        SELECT COUNT(*), COUNT(DISTINCT h.user_id), COALESCE(SUM(h.points), 0)
+        FROM history_search s JOIN points_history h ON h.id = s.rowid
+        WHERE history_search MATCH ?
+    """, (match,))
+    totals = cursor.fetchone()
+    cursor.execute("""
+        SELECT MAX(h.nickname), SUM(h.points), COUNT(*)
+        FROM history_search s JOIN points_history h ON h.id = s.rowid
+        WHERE history_search MATCH ?
+        GROUP BY h.user_id
+        ORDER BY SUM(h.points) DESC, h.user_id
+        LIMIT ? OFFSET ?
+    """, (match, limit, offset))
+    return totals, cursor.fetchall()
+
+def render_audit_page(token, page=0):
+    text = audit_queries[token]
+    started = time.perf_counter()
+    (awards, users, points), rows = search_history_notes(text, page * AUDIT_PAGE_SIZE)
+    elapsed = time.perf_counter() - started
+    logging.info(f"Audit search '{text}' page {page}: {awards} awards in {elapsed:.3f}s")
+    if not awards:
+        return f"По запросу \"{text}\" начислений не найдено", None
+
+    lines = [f"Начисления с примечанием \"{text}\"",
+             f"Найдено начислений: {awards}, пользователей: {users}, баллов: {points}", ""]
+    for i, (nickname, total, count) in enumerate(rows, start=page * AUDIT_PAGE_SIZE + 1):
+        lines.append(f"{i}. {nickname} - {total} баллов ({count} начисл.)")
+
+    pages = (users + AUDIT_PAGE_SIZE - 1) // AUDIT_PAGE_SIZE
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="« Назад", callback_data=f"audit:{token}:{page - 1}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton(text="Вперед »", callback_data=f"audit:{token}:{page + 1}"))
+    markup = InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
+    return "\n".join(lines), markup
+
+@router.message(Command(commands=["аудит"]))
+async def audit_command(message: Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    if not command.args:
+        await message.answer("Используйте: /аудит <слова из примечания>")
+        return
+    text = " ".join(command.args.split())
+    token = hashlib.blake2b(text.encode("utf-8"), digest_size=6).hexdigest()
+    audit_queries[token] = text
+    audit_queries.move_to_end(token)
+    while len(audit_queries) > AUDIT_QUERIES_SIZE:
+        audit_queries.popitem(last=False)
+    try:
+        page_text, markup = render_audit_page(token)
+    except sqlite3.OperationalError as e:
+        logging.error(f"Audit search error: {e}")
+        await message.answer("Не удалось разобрать запрос")
+        return
+    sent = await message.answer(page_text, reply_markup=markup)
+    remember_rendered(sent, page_text, markup)
+
+@router.callback_query(F.data.startswith("audit:"))
+async def audit_page(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer()
+        return
+    _, token, page = callback.data.split(":")
+    if token not in audit_queries:
+        await callback.answer("Запрос устарел, повторите /аудит", show_alert=True)
+        return
+    text, markup = render_audit_page(token, int(page))
+    await edit_message_text(callback.message, text, reply_markup=markup)
+    await callback.answer()
+
+# === Экспорт данных ===
+EXPORT_BATCH_ROWS = 1000
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+# Набор данных -> (имя файла, заголовок, запрос)
+EXPORTS = {
+    "пользователи": ("users", ("user_id", "nickname", "real_name", "phone", "category", "active", "points",
+                               "participations", "invited_by", "invites_count", "registration_date"),
+                     "SELECT user_id, nickname, real_name, phone, category, active, points, participations, "
+                     "invited_by, invites_count, registration_date FROM users ORDER BY user_id"),
+    "история": ("points_history", ("id", "user_id", "nickname", "points", "note", "timestamp"),
+                "SELECT id, user_id, nickname, points, note, timestamp FROM points_history ORDER BY id"),
+    "события": ("events", ("id", "name", "date", "starts_at", "completed", "award_points", "content"),
+                "SELECT id, name, date, starts_at, completed, award_points, content FROM events ORDER BY id"),
+    "приглашения": ("invites", ("user_id", "nickname", "invited_by", "inviter_nickname", "registration_date"),
+                    "SELECT u.user_id, u.nickname, u.invited_by, i.nickname, u.registration_date "
+                    "FROM users u LEFT JOIN users i ON i.user_id = u.invited_by "
+                    "WHERE u.invited_by IS NOT NULL ORDER BY u.user_id")
+}
+
+class CsvExportFile(InputFile):
+    """CSV, который формируется по частям прямо во время загрузки документа в Telegram"""
+
+    def __init__(self, filename, header, query, compress=False):
+        super().__init__(filename=filename + (".csv.gz" if compress else ".csv"), chunk_size=EXPORT_CHUNK_SIZE)
+        self.header = header
+        self.query = query
+        self.compress = compress
+        self.rows = 0
+
+    async def read(self, bot):
+        started = time.perf_counter()
+        # Отдельное соединение только для чтения, чтобы не держать курсор основного
+        db_file = conn.execute("PRAGMA database_list").fetchone()[2]
+        reader = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True, check_same_thread=False)
+        compressor = zlib.compressobj(wbits=31) if self.compress else None
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        buffer.write("\ufeff")
+        writer.writerow(self.header)
+        try:
+            rows = reader.execute(self.query)
+            while True:
+                batch = await asyncio.to_thread(rows.fetchmany, EXPORT_BATCH_ROWS)
+                writer.writerows(batch)
+                self.rows += len(batch)
+                data = buffer.getvalue().encode("utf-8")
+                buffer.seek(0)
+                buffer.truncate()
+                if compressor:
+                    data = compressor.compress(data)
+                if not batch:
+                    if compressor:
+                        data += compressor.flush()
+                    if data:
+                        yield data
+                    break
+                if data:
+                    yield data
+        finally:
+            reader.close()
+        logging.info(f"Exported {self.rows} rows to {self.filename} in {time.perf_counter() - started:.3f}s")
+
+@router.message(Command(commands=["экспорт"]))
+async def export_command(message: Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    args = (command.args or "").lower().split()
+    if not args or args[0] not in EXPORTS:
+        await message.answer(f"Используйте: /экспорт <{'|'.join(EXPORTS)}> [gz]")
+        return
+    filename, header, query = EXPORTS[args[0]]
+    export_file = CsvExportFile(filename, header, query, compress="gz" in args[1:])
+    await message.answer_document(export_file)
+
+# === Импорт данных ===
+IMPORT_MAX_SIZE = 20 * 1024 * 1024
+IMPORT_MAX_ERRORS = 20
+IMPORT_NOTE = "Импорт"
+
+def resolve_nicknames(nicknames):
+    """Находит user_id для набора никнеймов одним запросом"""
+    cursor.execute(
+        "SELECT nickname, user_id FROM users WHERE nickname IN (SELECT value FROM json_each(?))",
+        (json.dumps(list(nicknames)),)
+    )
+    return dict(cursor.fetchall())
+
+def parse_int(value, default=None):
+    value = (value or "").strip()
+    if not value:
+        return default
+    return int(value)
+
+def parse_import(rows):
+    """Проверяет строки CSV за один проход.
+    Возвращает новых пользователей, начисления (никнейм, баллы, примечание) и список ошибок"""
+    categories = {**CATEGORIES, **{name.lower(): name for name in CATEGORIES.values()}}
+    users, awards, errors = [], [], []
+    seen_ids, seen_nicknames = set(), set()
+
+    for line, row in enumerate(rows, start=2):
+        row_errors = len(errors)
+        try:
+            nickname = (row.get("nickname") or "").strip()
+            user_id = parse_int(row.get("user_id"))
+            points = parse_int(row.get("points"), 0)
+            if user_id is not None:
+                # Строка с user_id - новый пользователь
+                valid, error = is_valid_nickname(nickname)
+                category = categories.get((row.get("category") or "").strip().lower())
+                if not valid:
+                    errors.append(f"Строка {line}: {error}")
+                elif not category:
+                    errors.append(f"Строка {line}: неизвестная категория \"{row.get('category')}\"")
+                elif user_id in seen_ids or nickname in seen_nicknames:
+                    errors.append(f"Строка {line}: пользователь {nickname} повторяется")
+                else:
+                    seen_ids.add(user_id)
+                    seen_nicknames.add(nickname)
+                    users.append((user_id, nickname, (row.get("real_name") or "").strip() or None,
+                                  (row.get("phone") or "").strip() or None, category))
+            elif not nickname:
+                errors.append(f"Строка {line}: не указан nickname")
+            if points and len(errors) == row_errors:
+                awards.append((nickname, points, (row.get("note") or "").strip() or IMPORT_NOTE))
+        except ValueError:
+            errors.append(f"Строка {line}: user_id и points должны быть целыми числами")
+
+    # Никнеймы и id новых пользователей не должны быть заняты, а получатели начислений - существовать
+    existing = resolve_nicknames(seen_nicknames | {nickname for nickname, _, _ in awards})
+    if seen_ids:
+        cursor.execute("SELECT user_id FROM users WHERE user_id IN (SELECT value FROM json_each(?))",
+                       (json.dumps(list(seen_ids)),))
+        for (user_id,) in cursor.fetchall():
+            errors.append(f"Пользователь с user_id {user_id} уже зарегистрирован")
+    for user_id, nickname, _, _, _ in users:
+        if nickname in existing:
+            errors.append(f"Никнейм {nickname} уже занят")
+    for nickname, _, _ in awards:
+        if nickname not in existing and nickname not in seen_nicknames:
+            errors.append(f"Пользователь {nickname} не найден")
+    return users, awards, errors
+
+def apply_import(users, awards):
+    """Записывает пользователей и начисления одной транзакцией"""
+    with conn:
+        cursor.executemany("""
+            INSERT INTO users (user_id, nickname, real_name, phone, category, registration_date)
+            VALUES (?, ?, ?, ?, ?, datetime('now'))
+        """, users)
+        ids = resolve_nicknames({nickname for nickname, _, _ in awards})
+        apply_points([(ids[nickname], nickname, points, note) for nickname, points, note in awards])
+    invalidate_category_ranks()
+    invalidate_profiles()
+    search_cache.clear()
+
+@router.message(F.document, F.caption.startswith("/импорт"))
+async def import_command(message: Message):
+    """CSV с колонками user_id, nickname, real_name, phone, category (новые пользователи)
+    и/или nickname, points, note (начисления). Подпись \"/импорт проверка\" - только проверка"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    dry_run = "проверка" in message.caption.lower().split()
+    if message.document.file_size and message.document.file_size > IMPORT_MAX_SIZE:
+        await message.answer("Файл слишком большой для импорта")
+        return
+
+    buffer = io.BytesIO()
+    await bot.download(message.document, destination=buffer)
+    buffer.seek(0)
+
+    started = time.perf_counter()
+    try:
+        reader = csv.DictReader(io.TextIOWrapper(buffer, encoding="utf-8-sig", newline=""))
+        if not reader.fieldnames or "nickname" not in reader.fieldnames:
+            await message.answer("В файле нет колонки nickname")
+            return
+        users, awards, errors = parse_import(reader)
+        rows = reader.line_num - 1
+    except (UnicodeDecodeError, csv.Error) as e:
+        await message.answer(f"Не удалось прочитать CSV: {e}")
+        return
+    parsed = time.perf_counter() - started
+
+    summary = (f"Строк: {rows}, новых пользователей: {len(users)}, начислений: {len(awards)} "
+               f"на {sum(points for _, points, _ in awards)} баллов\n"
+               f"Проверка: {parsed:.2f} с ({rows / parsed if parsed else rows:.0f} строк/с)")
+    if errors:
+        shown = "\n".join(errors[:IMPORT_MAX_ERRORS])
+        more = f"\n...и еще {len(errors) - IMPORT_MAX_ERRORS}" if len(errors) > IMPORT_MAX_ERRORS else ""
+        await message.answer(f"{summary}\n\nОшибок: {len(errors)}, импорт не выполнен:\n{shown}{more}")
+        return
+    if dry_run:
+        await message.answer(f"{summary}\n\nОшибок нет. Для записи отправьте файл с подписью /импорт")
+        return
+
+    started = time.perf_counter()
+    try:
+        apply_import(users, awards)
+    except (sqlite3.Error, KeyError) as e:
+        # Пользователи могли измениться после проверки; транзакция уже откатилась
+        logging.error(f"Database error in import: {e}")
+        await message.answer(f"{summary}\n\nОшибка при записи, импорт отменен: {e}")
+        return
+    written = time.perf_counter() - started
+    audit_log.record(message.from_user.id, "импорт", message.document.file_name, users=len(users), awards=len(awards))
+    logging.info(f"Imported {len(users)} users and {len(awards)} awards in {written:.3f}s")
+    await message.answer(f"{summary}\nЗапись: {written:.2f} с ({rows / written if written else rows:.0f} строк/с)\n\n"
+                         f"Импорт выполнен")
+
+# === Сверка баланса ===
+RECONCILE_MAX_SHOWN = 20
+
+def get_meta(db, key, default=None):
+    row = db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+def set_meta(db, key, value):
+    db.execute(
+        "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+        (key, str(value)))
+
+def reconcile_balances(db, repair=False, full=False):
+    """Сверяет users.points и participations с историей начислений через подключение db.
+    Суммы истории накапливаются в balance_checkpoints, поэтому каждый запуск читает только новые строки истории"""
+    started = time.perf_counter()
+    cursor = db.cursor()
+    with db:
+        # Начисления с основного подключения не должны попасть между чтением max_id и записью контрольных сумм
+        cursor.execute("BEGIN IMMEDIATE")
+        if full:
+            cursor.execute("DELETE FROM balance_checkpoints")
+            set_meta(db, "reconcile_history_id", 0)
+        last_id = int(get_meta(db, "reconcile_history_id", 0))
+        cursor.execute("SELECT COALESCE(MAX(id), ?) FROM points_history", (last_id,))
+        max_id = cursor.fetchone()[0]
+
+        # Один проход по новым строкам истории с группировкой по пользователю
+        cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS reconcile_delta (user_id INTEGER PRIMARY KEY, points INTEGER, participations INTEGER)
+        """)
+        cursor.execute("DELETE FROM reconcile_delta")
+        cursor.execute("""
+            INSERT INTO reconcile_delta (user_id, points, participations)
+            SELECT h.user_id, SUM(h.points), COUNT(*)
+            FROM points_history h
+            WHERE h.id > ? AND h.id <= ? AND h.user_id IS NOT NULL
+            GROUP BY h.user_id
+        """, (last_id, max_id))
+        scanned = cursor.rowcount
+
+        cursor.execute("""
+            INSERT INTO balance_checkpoints (user_id, points, participations)
+            SELECT user_id, points, participations FROM reconcile_delta WHERE true
+            ON CONFLICT (user_id) DO UPDATE SET
+                points = points + excluded.points,
+                participations = participations + excluded.participations
+        """)
+        set_meta(db, "reconcile_history_id", max_id)
+
+        cursor.execute("""
+            SELECT u.user_id, u.nickname, u.points, u.participations,
+                   COALESCE(c.points, 0), COALESCE(c.participations, 0)
+            FROM users u LEFT JOIN balance_checkpoints c ON c.user_id = u.user_id
+            WHERE u.points != COALESCE(c.points, 0) OR u.participations != COALESCE(c.participations, 0)
+        """)
+        mismatches = cursor.fetchall()
+
+        if repair and mismatches:
+            cursor.executemany("UPDATE users SET points = ?, participations = ? WHERE user_id = ?",
+                               [(points, participations, user_id)
+                                for user_id, _, _, _, points, participations in mismatches])
+
+    elapsed = time.perf_counter() - started
+    logging.info(f"Reconciliation: history {last_id}..{max_id}, {scanned} users with new rows, "
+                 f"{len(mismatches)} mismatches{' repaired' if repair else ''} in {elapsed:.3f}s")
+    return mismatches
+
+async def reconcile(repair=False, full=False):
+    """Сверка в отдельном потоке; после исправления сбрасывает кэши рейтинга и профилей"""
+    mismatches = await run_in_db_thread(lambda db: reconcile_balances(db, repair=repair, full=full))
+    if repair and mismatches:
+        invalidate_category_ranks()
+        invalidate_profiles()
+    return mismatches
+
+def format_mismatches(mismatches, repaired=False):
+    if not mismatches:
+        return "Баланс сходится с историей начислений"
+    lines = [f"Расхождений: {len(mismatches)}" + (" (исправлено)" if repaired else "")]
+    for _, nickname, points, participations, expected_points, expected_participations in mismatches[:RECONCILE_MAX_SHOWN]:
+        lines.append(f"{nickname}: баллы {points} вместо {expected_points}, "
+                     f"участий {participations} вместо {expected_participations}")
+    if len(mismatches) > RECONCILE_MAX_SHOWN:
+        lines.append(f"...и еще {len(mismatches) - RECONCILE_MAX_SHOWN}")
+    return "\n".join(lines)
+
+@router.message(Command(commands=["сверка"]))
+async def reconcile_command(message: Message, command: CommandObject):
+    """/сверка [исправить] [полная]"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    args = (command.args or "").lower().split()
+    repair = "исправить" in args
+    mismatches = await reconcile(repair=repair, full="полная" in args)
+    if repair and mismatches:
+        audit_log.record(message.from_user.id, "сверка", repaired=len(mismatches),
+                         sample=[nickname for _, nickname, *_ in mismatches[:RECONCILE_MAX_SHOWN]])
+    await message.answer(format_mismatches(mismatches, repaired=repair))
+
+# === Статистика ===
+STATS_DAILY_COLUMNS = ("users_total", "users_active", "registrations", "awards", "points_awarded")
+
+def get_stats_counters():
+    cursor.execute("SELECT name, value FROM stats_counters")
+    return dict(cursor.fetchall())
+
+def get_stats_snapshot(day):
+    """Счетчики на конец дня day или ближайшего более раннего; если таких нет - самый ранний снимок"""
+    columns = ", ".join(STATS_DAILY_COLUMNS)
+    cursor.execute(f"SELECT {columns} FROM stats_daily WHERE day <= ? ORDER BY day DESC LIMIT 1", (day,))
+    row = cursor.fetchone()
+    if not row:
+        cursor.execute(f"SELECT {columns} FROM stats_daily ORDER BY day LIMIT 1")
+        row = cursor.fetchone()
+    return dict(zip(STATS_DAILY_COLUMNS, row)) if row else {}
+
+def write_stats_rollup(db, day):
+    """Сохраняет значения счетчиков на конец дня через подключение db"""
+    counters = dict(db.execute("SELECT name, value FROM stats_counters").fetchall())
+    db.execute(
+        f"INSERT OR REPLACE INTO stats_daily (day, {', '.join(STATS_DAILY_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?)",
+        (day, *(counters.get(name, 0) for name in STATS_DAILY_COLUMNS))
+    )
+
+def format_statistics():
+    counters = get_stats_counters()
+    today = datetime.date.today()
+    periods = (("сегодня", 1), ("7 дней", 7), ("30 дней", 30))
+    # Прирост за период - разница с итогом дня, предшествующего периоду
+    deltas = []
+    for title, days in periods:
+        base = get_stats_snapshot((today - datetime.timedelta(days=days)).isoformat())
+        deltas.append((title, {name: counters.get(name, 0) - base.get(name, 0) for name in STATS_DAILY_COLUMNS}))
+
+    total = counters.get("users_total", 0)
+    active = counters.get("users_active", 0)
+    invited = counters.get("invited_users", 0)
+    links = counters.get("invite_links", 0)
+    lines = [
+        "📊 Статистика",
+        "",
+        f"Пользователей: {total} (активных {active}, отключенных {total - active})",
+        "Регистрации: " + ", ".join(f"{title} {delta['registrations']}" for title, delta in deltas),
+        "Начислено баллов: " + ", ".join(f"{title} {delta['points_awarded']} ({delta['awards']} начисл.)"
+                                         for title, delta in deltas),
+        f"Всего начислено: {counters.get('points_awarded', 0)} баллов, {counters.get('awards', 0)} начислений",
+        "",
+        f"Пригласительных ссылок: {links}, пришли по приглашению: {invited}",
+        f"Конверсия: {invited / links if links else 0:.2f} регистраций на ссылку, "
+        f"{invited * 100 / total if total else 0:.1f}% пользователей"
+    ]
+    return "\n".join(lines)
+
+@router.message(Command(commands=["статистика"]))
+async def statistics_command(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    await message.answer(format_statistics())
+
+AUDIT_LOG_LIMIT = 30
+# Длинные примечания обрезаются, чтобы журнал помещался в одно сообщение
+AUDIT_LINE_LIMIT = 200
+
+def query_audit_log(admin_id=None, target=None, days=7, limit=AUDIT_LOG_LIMIT):
+    """Последние записи журнала с фильтрами по администратору, цели и периоду"""
+    since = (datetime.datetime.now() - datetime.timedelta(days=days)).strftime(JOB_TIME_FORMAT)
+    conditions, params = ["created_at >= ?"], [since]
+    if admin_id is not None:
+        conditions.append("admin_id = ?")
+        params.append(admin_id)
+    if target is not None:
+        conditions.append("target = ?")
+        params.append(target)
+    cursor.execute(f"""
+        SELECT created_at, admin_id, action, target, details FROM admin_audit
+        WHERE {' AND '.join(conditions)}
+        ORDER BY created_at DESC LIMIT ?
+    """, (*params, limit))
+    return cursor.fetchall()
+
+@router.message(Command(commands=["журнал"]))
+async def audit_log_command(message: Message, command: CommandObject):
+    """/журнал [админ=<id>] [цель=<ник или event:id>] [дней=<N>]"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    filters = dict(arg.split("=", 1) for arg in (command.args or "").split() if "=" in arg)
+    try:
+        admin_id = int(filters["админ"]) if "админ" in filters else None
+        days = int(filters.get("дней", 7))
+    except ValueError:
+        await message.answer("Используйте: /журнал [админ=<id>] [цель=<ник>] [дней=<N>]")
+        return
+
+    # Показываем и записи, которые еще не успели попасть в БД
+    audit_log.flush()
+    rows = query_audit_log(admin_id, filters.get("цель"), days)
+    if not rows:
+        await message.answer(f"За {days} дн. записей нет")
+        return
+    lines = []
+    for created_at, row_admin, action, target, details in rows:
+        details_text = ", ".join(f"{key}={value}" for key, value in json.loads(details).items()) if details else ""
+        line = f"{created_at[:16]} {row_admin} /{action} {target or ''} {details_text}".rstrip()
+        lines.append(line if len(line) <= AUDIT_LINE_LIMIT else f"{line[:AUDIT_LINE_LIMIT - 1]}…")
+    await message.answer(fit_lines(f"Журнал действий за {days} дн. (последние {len(rows)}):\n\n", lines))
+
 @router.message(Command(commands=["выдать"]))
 async def give_points(message: Message):
     if message.from_user.id not in ADMIN_IDS:
@@ -839,50 +3295,99 @@ async def give_points(message: Message):
         await message.answer("Пользователь с таким никнеймом не найден.")
         return
     await add_points(nickname, points, note)
+    audit_log.record(message.from_user.id, "выдать", nickname, points=points, note=note)
     await message.answer(f"Выдано {points} баллов для {nickname}. Примечание: {note}")
 
 def reset_user_rating(nickname: str):
     """Обнуляет рейтинг пользователя и удаляет историю начислений"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    try:
+    with conn:
         # Обнуляем рейтинг
-        cursor.execute("UPDATE users SET points = 0, participations = 0 WHERE nickname = ?", (nickname,))
+        cursor.execute("SELECT user_id FROM users WHERE nickname = ?", (nickname,))
+        row = cursor.fetchone()
+        if not row:
+            return
+        user_id = row[0]
+        cursor.execute("UPDATE users SET points = 0, participations = 0 WHERE user_id = ?", (user_id,))
+        cursor.execute("DELETE FROM points_rollup WHERE user_id = ?", (user_id,))
         # Удаляем историю начислений
-        cursor.execute("DELETE FROM points_history WHERE nickname = ?", (nickname,))
-        conn.commit()
-    finally:
-        conn.close()
+        cursor.execute("DELETE FROM balance_checkpoints WHERE user_id = ?", (user_id,))
+        cursor.execute("DELETE FROM points_history WHERE user_id = ?", (user_id,))
+    invalidate_category_ranks()
+    invalidate_profiles(profile_ids.get(nickname))
+
+def close_season(new_season_name: str) -> dict:
+    """Закрывает текущий сезон одной транзакцией: сохраняет итоги, переносит историю в архив и обнуляет очки"""
+    global current_season_id
+    started = time.perf_counter()
+    closing_id = current_season_id
+
+    with conn:
+        cursor.execute("""
+            INSERT INTO season_standings (season_id, user_id, nickname, category, rank, points, participations)
+            SELECT ?, user_id, nickname, category, RANK() OVER (ORDER BY points DESC), points, participations
+            FROM users
+        """, (closing_id,))
+        standings = cursor.rowcount
+
+        cursor.execute("""
+            INSERT INTO points_history_archive (id, season_id, user_id, nickname, points, note, timestamp)
+            SELECT id, ?, user_id, nickname, points, note, timestamp FROM points_history
+        """, (closing_id,))
+        archived = cursor.rowcount
+        cursor.execute("DELETE FROM points_history")
+        cursor.execute("DELETE FROM balance_checkpoints")
+
+        cursor.execute("UPDATE users SET points = 0, participations = 0 WHERE points != 0 OR participations != 0")
+        reset = cursor.rowcount
+        # Недельный и месячный рейтинги продолжаются через границу сезона
+        cursor.execute("DELETE FROM points_rollup WHERE period = 'season'")
+
+        cursor.execute("UPDATE seasons SET closed_at = CURRENT_TIMESTAMP WHERE id = ?", (closing_id,))
+        cursor.execute("INSERT INTO seasons (name) VALUES (?)", (new_season_name,))
+        new_season_id = cursor.lastrowid
+
+    current_season_id = new_season_id
+    invalidate_category_ranks()
+    invalidate_profiles()
+    elapsed = time.perf_counter() - started
+    logging.info(f"Season {closing_id} closed: {standings} standings, {archived} history rows archived, "
+                 f"{reset} users reset in {elapsed:.3f}s")
+    return {
+        "season_id": closing_id,
+        "new_season_id": new_season_id,
+        "standings": standings,
+        "archived": archived,
+        "reset": reset,
+        "elapsed": elapsed
+    }
 
 def delete_user_by_id_or_nickname(identifier):
     """Полностью удаляет пользователя из базы данных по ID или никнейму"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    # Определяем тип идентификатора и получаем данные пользователя
     try:
-        # Определяем тип идентификатора и получаем данные пользователя
-        try:
-            user_id = int(identifier)
-            cursor.execute("SELECT nickname, photo_path FROM users WHERE user_id = ?", (user_id,))
-        except ValueError:
-            cursor.execute("SELECT nickname, photo_path FROM users WHERE nickname = ?", (identifier,))
-
-        result = cursor.fetchone()
-        if not result:
-            return None
-
-        nickname, photo_path = result
-
-        # Удаляем фото если есть
-        if photo_path and os.path.exists(photo_path):
-            os.remove(photo_path)
+        user_id = int(identifier)
+        cursor.execute("SELECT user_id, nickname, photo_path, category FROM users WHERE user_id = ?", (user_id,))
+    except ValueError:
+        cursor.execute("SELECT user_id, nickname, photo_path, category FROM users WHERE nickname = ?", (identifier,))
 
-        # Удаляем пользователя и его историю
-        cursor.execute("DELETE FROM users WHERE nickname = ?", (nickname,))
-        cursor.execute("DELETE FROM points_history WHERE nickname = ?", (nickname,))
-        conn.commit()
-        return nickname
-    finally:
-        conn.close()
+    result = cursor.fetchone()
+    if not result:
+        return None
+
+    user_id, nickname, photo_path, category = result
+
+    # Файл фото удалит сборщик мусора хранилища, если на него больше никто не ссылается
+    # Удаляем пользователя и его историю
+    with conn:
+        cursor.execute("DELETE FROM points_rollup WHERE user_id = ?", (user_id,))
+        cursor.execute("DELETE FROM balance_checkpoints WHERE user_id = ?", (user_id,))
+        cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+        cursor.execute("DELETE FROM points_history WHERE user_id = ?", (user_id,))
+    invalidate_category_ranks(category)
+    invalidate_profiles()
+    search_cache.clear()
+    invite_tree_cache.clear()
+    return nickname
 
 @router.message(Command(commands=["удалить"]))
 async def delete_user_command(message: Message):
@@ -900,6 +3405,7 @@ async def delete_user_command(message: Message):
         await message.answer("Пользователь не найден.")
         return
 
+    audit_log.record(message.from_user.id, "удалить", nickname, identifier=identifier)
     await message.answer(f"Пользователь {nickname} полностью удален из системы.")
 
 @router.message(Command(commands=["обнулить"]))
@@ -916,6 +3422,7 @@ async def reset_rating_command(message: Message):
         await message.answer("Пользователь не найден.")
         return
     reset_user_rating(nickname)
+    audit_log.record(message.from_user.id, "обнулить", nickname, points=user[6], participations=user[7])
     await message.answer(f"Рейтинг пользователя {nickname} обнулен, история начислений удалена.")
 
 @router.message(Command(commands=["отключить"]))
@@ -931,6 +3438,7 @@ async def disable_user_command(message: Message):
         await message.answer("Пользователь не найден.")
         return
     disable_user(nickname)
+    audit_log.record(message.from_user.id, "отключить", nickname)
     await message.answer(f"Пользователь {nickname} был отключён и будет зачёркнут в рейтинге.")
 
 @router.message(Command(commands=["обновить_фото"]))
@@ -956,55 +3464,35 @@ async def handle_photo(message: Message, state: FSMContext):
         if not nickname:
             return
 
+        # Размеры известны из PhotoSize, горизонтальное фото отклоняем без скачивания
         photo = message.photo[-1]
-        file = await bot.get_file(photo.file_id)
-        ext = "jpg"
-        path = f"photos/{nickname}.{ext}"
-        temp_path = f"photos/temp_{nickname}.{ext}"
-
-        os.makedirs("photos", exist_ok=True)
-
-        # Сначала сохраняем во временный файл
-        await bot.download_file(file.file_path, destination=temp_path)
+        if photo.width > photo.height:
+            await message.answer("Пожалуйста, отправьте вертикальное фото (высота должна быть больше ширины)")
+            return
+        if photo.file_size and photo.file_size > PHOTO_MAX_SIZE:
+            await message.answer("Фото слишком большое.")
+            return
 
         try:
-            with Image.open(temp_path) as img:
-                width, height = img.size
-                if width > height:
-                    await message.answer("Пожалуйста, отправьте вертикальное фото (высота должна быть больше ширины)")
-                    return
-
-                # Оптимизируем размер
-                if width > 1080:
-                    new_width = 1080
-                    new_height = int(height * (1080 / width))
-                    img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-
-                # Сохраняем оптимизированное фото
-                img.save(path, format='JPEG', quality=85, optimize=True)
-
-            # Удаляем старое фото если оно существует
-            if os.path.exists(path) and path != temp_path:
-                try:
-                    os.remove(path)
-                except OSError:
-                    pass
-
+            # Скачиваем в память и пишем на диск один раз, уже обработанное фото
+            file = await bot.get_file(photo.file_id)
+            buffer = CappedBuffer(PHOTO_MAX_SIZE)
+            await bot.download_file(file.file_path, destination=buffer)
+            data = await asyncio.to_thread(prepare_profile_photo, buffer.getvalue())
+            if data is None:
+                await message.answer("Пожалуйста, отправьте вертикальное фото (высота должна быть больше ширины)")
+                return
+
+            # Старое фото удалит сборщик мусора хранилища
+            path = await photo_store.put(data)
             update_user_photo(nickname, path)
+            audit_log.record(message.from_user.id, "обновить_фото", nickname, path=path)
             await message.answer("Фото успешно обновлено!")
 
         except Exception as e:
             logging.error(f"Error processing image: {e}")
             await message.answer("Ошибка при обработке изображения.")
 
-        finally:
-            # Удаляем временный файл
-            try:
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
-            except OSError:
-                pass
-
     except Exception as e:
         logging.error(f"Error in handle_photo: {e}")
         await message.answer("Произошла ошибка при обработке фото.")
@@ -1033,7 +3521,7 @@ async def update_profile_start(callback: CallbackQuery, state: FSMContext):
     if callback.message.photo:
         await callback.message.edit_caption(caption=current_text, reply_markup=markup)
     else:
-        await callback.message.edit_text(text=current_text, reply_markup=markup)
+        await edit_message_text(callback.message, current_text, reply_markup=markup)
 
     msg = await callback.message.answer("Ваш номер телефона (видит только администратор):")
     await state.update_data(last_message_id=msg.message_id)
@@ -1067,12 +3555,34 @@ async def update_profile_real_name(message: Message, state: FSMContext):
 @router.callback_query(F.data.startswith("update_category:"))
 async def update_profile_category(callback: CallbackQuery, state: FSMContext):
     _, category = callback.data.split(":")
+    if category not in CATEGORIES.values():
+        await callback.answer("Неверная категория")
+        return
+    user = get_user(callback.from_user.id)
     update_user(callback.from_user.id, "category", category)
+    # Пользователь уходит из одной категории и появляется в другой
+    invalidate_category_ranks(user[4] if user else None, category)
     await callback.message.answer("Данные успешно обновлены!")
     await state.clear()
 
 
 # === Запуск ===
+async def run_in_db_thread(work):
+    """Выполняет блокирующую работу с БД в отдельном потоке на собственном подключении.
+    work(db) получает подключение, изменения фиксируются после успешного завершения"""
+    # Незавершенная транзакция основного подключения держала бы блокировку записи
+    conn.commit()
+    db_file = conn.execute("PRAGMA database_list").fetchone()[2]
+
+    def run():
+        db = sqlite3.connect(db_file, timeout=30)
+        try:
+            with db:
+                return work(db)
+        finally:
+            db.close()
+    return await asyncio.to_thread(run)
+
 async def backup_database():
     """Создание резервной копии базы данных"""
     try:
@@ -1082,9 +3592,14 @@ async def backup_database():
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         backup_path = f"{backup_dir}/backup_{timestamp}.sqlite"
 
-        # Создаем копию базы
-        with open(DB_PATH, 'rb') as source, open(backup_path, 'wb') as target:
-            target.write(source.read())
+        # Создаем копию базы через backup API: в режиме WAL часть данных может быть еще не в основном файле
+        def copy_database(db):
+            target = sqlite3.connect(backup_path)
+            try:
+                db.backup(target)
+            finally:
+                target.close()
+        await run_in_db_thread(copy_database)
 
         # Удаляем старые бэкапы (оставляем только последние 7)
         backup_files = sorted([f for f in os.listdir(backup_dir) if f.startswith("backup_")])
@@ -1095,12 +3610,103 @@ async def backup_database():
     except Exception as e:
         logging.error(f"Backup error: {e}")
 
-async def scheduled_backup():
-    """Запуск регулярного бэкапа"""
-    while True:
-        await backup_database()
-        # Ждем 24 часа
-        await asyncio.sleep(24 * 60 * 60)
+# Регулярные задачи: имя -> (обработчик, расписание cron)
+DEFAULT_JOBS = {
+    "backup": ("backup", "0 3 * * *"),
+    "analyze": ("analyze", "30 3 * * *"),
+    "vacuum": ("vacuum", "0 4 * * 0"),
+    "cache_sweep": ("cache_sweep", "*/30 * * * *"),
+    "reconcile": ("reconcile", "15 4 * * *"),
+    "photo_gc": ("photo_gc", "45 4 * * *"),
+    "stats_rollup": ("stats_rollup", "0 0 * * *"),
+    "audit_retention": ("audit_retention", "30 4 * * *"),
+    "rank_snapshot": ("rank_snapshot", "0 0 * * *")
+}
+
+@scheduler.handler("backup")
+async def backup_job(payload):
+    await backup_database()
+
+@scheduler.handler("analyze")
+async def analyze_job(payload):
+    """Обновляет статистику планировщика запросов SQLite"""
+    def analyze(db):
+        db.execute("ANALYZE")
+        db.execute("PRAGMA optimize")
+    await run_in_db_thread(analyze)
+
+@scheduler.handler("vacuum")
+async def vacuum_job(payload):
+    await run_in_db_thread(lambda db: db.execute("VACUUM"))
+
+@scheduler.handler("reconcile")
+async def reconcile_job(payload):
+    """Ежедневная сверка баланса, о расхождениях сообщает администраторам"""
+    mismatches = await reconcile()
+    if mismatches:
+        for admin_id in ADMIN_IDS:
+            notifications.put(admin_id, f"Сверка баланса\n{format_mismatches(mismatches)}\n\nИсправить: /сверка исправить")
+
+@scheduler.handler("photo_gc")
+async def photo_gc_job(payload):
+    referenced = await run_in_db_thread(lambda db: {path for (path,) in db.execute(
+        "SELECT DISTINCT photo_path FROM users WHERE photo_path IS NOT NULL")})
+    await photo_store.collect_garbage(referenced)
+
+@scheduler.handler("stats_rollup")
+async def stats_rollup_job(payload):
+    """Запускается в полночь и сохраняет итоги прошедшего дня (после простоя - всех пропущенных дней)"""
+    days = missed_days(scheduled_run.get())
+
+    def write(db):
+        for day in days:
+            write_stats_rollup(db, day)
+    await run_in_db_thread(write)
+
+@scheduler.handler("audit_retention")
+async def audit_retention_job(payload):
+    """Сворачивает записи журнала старше AUDIT_RETENTION_DAYS в помесячные итоги и удаляет их"""
+    audit_log.flush()
+    cutoff = (datetime.datetime.now() - datetime.timedelta(days=AUDIT_RETENTION_DAYS)).strftime(JOB_TIME_FORMAT)
+
+    def compact(db):
+        db.execute("""
+            INSERT INTO admin_audit_summary (month, admin_id, action, count)
+            SELECT substr(created_at, 1, 7), admin_id, action, COUNT(*) FROM admin_audit
+            WHERE created_at < ? GROUP BY 1, 2, 3
+            ON CONFLICT (month, admin_id, action) DO UPDATE SET count = count + excluded.count
+        """, (cutoff,))
+        return db.execute("DELETE FROM admin_audit WHERE created_at < ?", (cutoff,)).rowcount
+    removed = await run_in_db_thread(compact)
+    logging.info(f"Audit log retention: {removed} entries compacted")
+
+@scheduler.handler("rank_snapshot")
+async def rank_snapshot_job(payload):
+    """Запускается в полночь и сохраняет места на конец прошедшего дня (после простоя - всех пропущенных дней)"""
+    days = missed_days(scheduled_run.get())
+
+    def write(db):
+        for day in days:
+            write_rank_snapshot(db, day)
+    await run_in_db_thread(write)
+    rank_snapshot_cache.clear()
+
+@scheduler.handler("cache_sweep")
+async def cache_sweep_job(payload):
+    """Очищает кэши в памяти и брошенные незавершенные регистрации"""
+    invite_tree_cache.clear()
+    category_rank_cache.clear()
+    event_cache.clear()
+    await run_in_db_thread(lambda db: db.execute("DELETE FROM temp_registration WHERE timestamp < datetime('now', '-1 day')"))
+
+def create_app():
+    """Создает бота и подключает БД. PIL и qrcode загружаются позже, при первом использовании"""
+    global bot
+    init_db()
+    photo_store.load()
+    if bot is None:
+        bot = Bot(token=TOKEN)
+    return bot, dp
 
 async def main():
     # Проверка токена
@@ -1108,8 +3714,12 @@ async def main():
         logging.error("No bot token provided! Please set BOT_TOKEN in Secrets")
         return
 
-    # Запускаем задачу бэкапа
-    asyncio.create_task(scheduled_backup())
+    create_app()
+
+    # Запускаем планировщик (бэкапы, обслуживание БД, напоминания о событиях)
+    scheduler.start(DEFAULT_JOBS)
+    notifications.start()
+    audit_log.start()
 
     retry_count = 0
     max_retries = 5
@@ -1132,26 +3742,22 @@ async def main():
 def get_user_history(nickname: str) -> tuple[str, bool]:
     """Получает историю начислений пользователя"""
     logging.info(f"Getting history for user: {nickname}")
-    conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-
         # Проверяем существование пользователя
-        cur.execute("SELECT * FROM users WHERE nickname = ?", (nickname,))
-        user = cur.fetchone()
+        cursor.execute("SELECT user_id FROM users WHERE nickname = ?", (nickname,))
+        user = cursor.fetchone()
         if not user:
             logging.info(f"User {nickname} not found")
             return "История пуста", True
 
-        # Получаем историю начислений
-        cur.execute("""
-            SELECT timestamp, points, note 
-            FROM points_history 
-            WHERE nickname = ? 
+        # Получаем историю начислений (индекс по user_id и времени)
+        cursor.execute("""
+            SELECT timestamp, points, note
+            FROM points_history
+            WHERE user_id = ?
             ORDER BY timestamp DESC
-        """, (nickname,))
-        history = cur.fetchall()
+        """, (user[0],))
+        history = cursor.fetchall()
         logging.info(f"Found {len(history)} history records for {nickname}")
 
         if not history:
@@ -1170,9 +3776,6 @@ def get_user_history(nickname: str) -> tuple[str, bool]:
     except Exception as e:
         logging.error(f"Error in get_user_history: {e}")
         return "Произошла ошибка", True
-    finally:
-        if conn:
-            conn.close()
 
 @router.message(Command(commands=["история"]))
 async def history_command(message: Message):
@@ -1234,7 +3837,7 @@ async def showpoints_history(callback: CallbackQuery):
             await callback.message.delete()
         else:
             try:
-                await callback.message.edit_text(history_text, reply_markup=markup, parse_mode=ParseMode.HTML)
+                await edit_message_text(callback.message, history_text, reply_markup=markup, parse_mode=ParseMode.HTML)
             except Exception as edit_error:
                 logging.error(f"Error editing message: {edit_error}")
                 await callback.message.answer(history_text, reply_markup=markup)
@@ -1255,43 +3858,20 @@ async def showpoints_history(callback: CallbackQuery):
 async def back_to_profile(callback: CallbackQuery):
     try:
         nickname = callback.data.split(":")[1]
-        user = get_user_by_nickname(nickname)
-        if not user:
-            await callback.message.edit_text("Пользователь не найден")
+        card = await get_profile_card(viewer_role(callback.from_user.id), nickname=nickname)
+        if not card:
+            await edit_message_text(callback.message, "Пользователь не найден")
             return
 
-        # Получаем информацию о пользователе из Telegram
-        try:
-            chat = await bot.get_chat(user[0])
-            username = f"@{chat.username}" if chat.username else "не указан"
-        except Exception as e:
-            logging.error(f"Error getting username: {e}")
-            username = "не указан"
-
-        # Форматируем дату регистрации
-        try:
-            registration_date = user[9].split('.')[0].replace('T', ' ') if user[9] else "Не указана"
-        except (IndexError, AttributeError):
-            registration_date = "Не указана"
-
-        if callback.from_user.id in ADMIN_IDS:
-            profile_text = f"Профиль пользователя {nickname}:\nИмя: {user[2]}\nКатегория: {user[4]}\nБаллы: {user[6]}\nУчастий: {user[7]}\n\nTelegram: {username}\nID: {user[0]}\nДата регистрации: {registration_date}"
-        else:
-            profile_text = f"Профиль пользователя {nickname}:\nИмя: {user[2]}\nКатегория: {user[4]}\nБаллы: {user[6]}\nУчастий: {user[7]}"
-
-        buttons = [[InlineKeyboardButton(text="История начислений", callback_data=f"history:{user[1]}")]]
-        markup = InlineKeyboardMarkup(inline_keyboard=buttons)
-
-        photo_path = user[8] if len(user) > 8 else None
-        if photo_path and os.path.exists(photo_path):
+        if card.photo:
             await callback.message.delete()
-            await callback.message.answer_photo(photo=FSInputFile(photo_path), caption=profile_text, reply_markup=markup)
+            await send_profile_card(callback.message, card)
         else:
-            await callback.message.edit_text(profile_text, reply_markup=markup)
+            await edit_message_text(callback.message, card.text, reply_markup=card.markup)
         await callback.answer()
     except Exception as e:
         logging.error(f"Error in back_to_profile: {e}")
-        await callback.message.edit_text("Произошла ошибка при возврате к профилю")
+        await edit_message_text(callback.message, "Произошла ошибка при возврате к профилю")
 
 @router.message(Command(commands=["удалить_событие"]))
 async def delete_event(message: Message):
@@ -1300,16 +3880,26 @@ async def delete_event(message: Message):
 
     args = message.text.split(maxsplit=1)
     if len(args) < 2:
-        await message.answer("Используйте: /удалить_событие <название события>")
+        await message.answer("Используйте: /удалить_событие <название или id события>")
         return
 
     event_name = args[1]
-    if event_name in EVENTS:
-        del EVENTS[event_name]
-        delete_event_db(event_name)
-        await message.answer(f"Событие \"{event_name}\" удалено")
-    else:
+    event_ids = find_events_by_name(event_name)
+    if not event_ids and event_name.isdigit() and get_event(int(event_name)):
+        event_ids = [int(event_name)]
+
+    if not event_ids:
         await message.answer("Событие не найдено")
+    elif len(event_ids) > 1:
+        await message.answer(
+            f"Найдено несколько событий \"{event_name}\" (id: {', '.join(map(str, event_ids))}). "
+            f"Укажите id события."
+        )
+    else:
+        event = get_event(event_ids[0])
+        delete_event_db(event_ids[0])
+        audit_log.record(message.from_user.id, "удалить_событие", f"event:{event_ids[0]}", name=event["name"])
+        await message.answer(f"Событие \"{event['name']}\" удалено")
 
 @router.message(Command(commands=["бэкап"]))
 async def manual_backup(message: Message):
@@ -1318,6 +3908,177 @@ async def manual_backup(message: Message):
     await backup_database()
     await message.answer("Резервная копия базы данных создана")
 
+@router.message(Command(commands=["закрыть_сезон"]))
+async def close_season_command(message: Message, state: FSMContext):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    args = message.text.split(maxsplit=1)
+    new_season_name = args[1] if len(args) > 1 else f"Сезон {datetime.datetime.now().strftime('%d.%m.%Y')}"
+
+    cursor.execute("SELECT name FROM seasons WHERE id = ?", (current_season_id,))
+    season_name = cursor.fetchone()[0]
+    users_count = get_total_users()
+    cursor.execute("SELECT COUNT(*) FROM points_history")
+    history_count = cursor.fetchone()[0]
+
+    await state.update_data(new_season_name=new_season_name)
+    markup = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="Закрыть сезон", callback_data="season_close:confirm"),
+        InlineKeyboardButton(text="Отмена", callback_data="season_close:cancel")
+    ]])
+    await message.answer(
+        f"Сезон \"{season_name}\" будет закрыт.\n\n"
+        f"Участников в итоговой таблице: {users_count}\n"
+        f"Записей истории в архив: {history_count}\n\n"
+        f"Очки и участия всех пользователей будут обнулены, начнется сезон \"{new_season_name}\".",
+        reply_markup=markup
+    )
+
+@router.callback_query(F.data.startswith("season_close:"))
+async def close_season_confirm(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("Недостаточно прав")
+        return
+
+    data = await state.get_data()
+    new_season_name = data.get("new_season_name")
+    await state.update_data(new_season_name=None)
+    if callback.data != "season_close:confirm" or not new_season_name:
+        await callback.message.edit_text("Закрытие сезона отменено")
+        await callback.answer()
+        return
+
+    await callback.message.edit_text("Закрываем сезон...")
+    await backup_database()
+    try:
+        result = close_season(new_season_name)
+    except sqlite3.Error as e:
+        logging.error(f"Database error in close_season: {e}")
+        await callback.message.edit_text("Ошибка при закрытии сезона, изменения отменены")
+        return
+    audit_log.record(callback.from_user.id, "закрыть_сезон", f"season:{result['season_id']}",
+                     new_season=new_season_name, reset=result["reset"])
+
+    await callback.message.edit_text(
+        f"Сезон закрыт за {result['elapsed']:.2f} с\n\n"
+        f"Итоговая таблица: {result['standings']} участников\n"
+        f"Перенесено в архив: {result['archived']} записей\n"
+        f"Обнулено пользователей: {result['reset']}\n\n"
+        f"Начат сезон \"{new_season_name}\""
+    )
+    await callback.answer()
+
+@router.message(Command(commands=["сезоны"]))
+async def seasons_command(message: Message):
+    cursor.execute("""
+        SELECT s.id, s.name, s.started_at, s.closed_at, w.winner, w.winners, w.points
+        FROM seasons s
+        LEFT JOIN (
+            -- Делящие первое место сворачиваются в одну строку
+            SELECT season_id, MIN(nickname) AS winner, COUNT(*) AS winners, MAX(points) AS points
+            FROM season_standings
+            WHERE rank = 1 AND points > 0
+            GROUP BY season_id
+        ) w ON w.season_id = s.id
+        ORDER BY s.id DESC
+        LIMIT 20
+    """)
+    text = "Сезоны рейтинга:\n\n"
+    for season_id, name, started_at, closed_at, winner, winners, points in cursor.fetchall():
+        if closed_at:
+            text += f"{name} ({started_at[:10]} — {closed_at[:10]})"
+            if winner:
+                shared = f" и еще {winners - 1}" if winners > 1 else ""
+                text += f": 🏆 {winner}{shared} - {points} баллов\n"
+            else:
+                text += "\n"
+        else:
+            text += f"⚡️ {name} (с {started_at[:10]}) — текущий\n"
+    await message.answer(text)
+
+# Кэш деревьев приглашений: {(никнейм, глубина): строки дерева}
+invite_tree_cache = {}
+
+def get_invite_tree(nickname: str, depth: int):
+    """Возвращает дерево приглашенных в порядке обхода в глубину: (никнейм, уровень, приглашений)"""
+    key = (nickname, depth)
+    if key not in invite_tree_cache:
+        cursor.execute("""
+            WITH RECURSIVE tree (user_id, nickname, invites_count, level) AS (
+                SELECT user_id, nickname, invites_count, 0 FROM users WHERE nickname = ?
+                UNION ALL
+                SELECT u.user_id, u.nickname, u.invites_count, tree.level + 1
+                FROM users u JOIN tree ON u.invited_by = tree.user_id
+                WHERE tree.level < ?
+                ORDER BY 4 DESC
+            )
+            SELECT nickname, level, invites_count FROM tree
+        """, (nickname, depth))
+        invite_tree_cache[key] = cursor.fetchall()
+    return invite_tree_cache[key]
+
+@router.message(Command(commands=["топ_приглашений"]))
+async def top_inviters_command(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    cursor.execute(
+        "SELECT nickname, invites_count FROM users WHERE invites_count > 0 ORDER BY invites_count DESC LIMIT 20"
+    )
+    inviters = cursor.fetchall()
+    if not inviters:
+        await message.answer("Приглашений пока нет")
+        return
+    text = "🏆 Топ пригласивших:\n\n"
+    for i, (nickname, invites_count) in enumerate(inviters, start=1):
+        text += f"{i}. {nickname} - {invites_count}\n"
+    await message.answer(text)
+
+@router.message(Command(commands=["дерево_приглашений"]))
+async def invite_tree_command(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    args = message.text.split()
+    if len(args) < 2:
+        await message.answer("Используйте: /дерево_приглашений <ник> [глубина]")
+        return
+    nickname = args[1]
+    try:
+        depth = min(max(int(args[2]), 1), 10) if len(args) > 2 else 3
+    except ValueError:
+        await message.answer("Глубина должна быть числом")
+        return
+
+    tree = get_invite_tree(nickname, depth)
+    if not tree:
+        await message.answer("Пользователь не найден.")
+        return
+
+    levels = {}
+    for _, level, _ in tree[1:]:
+        levels[level] = levels.get(level, 0) + 1
+    text = f"Дерево приглашений {nickname}:\n"
+    text += ", ".join(f"уровень {level}: {count}" for level, count in sorted(levels.items())) or "приглашений нет"
+    text += "\n\n"
+    lines = [f"{'   ' * (level - 1)}└ {tree_nickname} ({invites_count})" for tree_nickname, level, invites_count in tree[1:]]
+    await message.answer(fit_lines(text, lines))
+
+@router.message(Command(commands=["задачи"]))
+async def scheduled_jobs_command(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    cursor.execute("SELECT name, cron, next_run, last_run FROM scheduled_jobs ORDER BY next_run LIMIT 30")
+    jobs = cursor.fetchall()
+    if not jobs:
+        await message.answer("Запланированных задач нет")
+        return
+    text = "Запланированные задачи:\n\n"
+    for name, cron, next_run, last_run in jobs:
+        text += f"{name} ({cron or 'разово'})\nСледующий запуск: {next_run}\n"
+        if last_run:
+            text += f"Последний запуск: {last_run}\n"
+        text += "\n"
+    await message.answer(text)
+
 async def get_or_create_invite_link(user_id: int, nickname: str) -> str:
     try:
         # Сначала проверяем, есть ли уже ссылка у пользователя
@@ -1369,6 +4130,8 @@ async def my_invite(message: Message):
 
         # Создаем QR-код
         try:
+            import qrcode
+
             qr = qrcode.QRCode(version=1, box_size=10, border=5)
             qr.add_data(invite_link)
             qr.make(fit=True)
@@ -1442,47 +4205,26 @@ async def cancel_profile_update(callback: CallbackQuery, state: FSMContext):
         # Очищаем состояние
         await state.clear()
 
-        # Получаем актуальные данные пользователя
-        user = get_user(callback.from_user.id)
-        if not user:
+        # Получаем актуальную карточку профиля
+        card = await get_profile_card(PROFILE_OWN, user_id=callback.from_user.id)
+        if not card:
             await callback.answer("Ошибка при получении данных профиля")
             return
 
-        # Создаем стандартную клавиатуру
-        buttons = [
-            [InlineKeyboardButton(text="История начислений", callback_data=f"history:{user[1]}")],
-            [InlineKeyboardButton(text="Обновить данные", callback_data="update_profile")]
-        ]
-        markup = InlineKeyboardMarkup(inline_keyboard=buttons)
-
-        # Формируем текст профиля
-        profile_text = f"Ваш профиль:\nНикнейм: {user[1]}\nИмя: {user[2]}\nТелефон: {user[3]}\nКатегория: {user[4]}\nБаллы: {user[6]}\nУчастий: {user[7]}"
-
         # Обновляем или отправляем новое сообщение с профилем
-        photo_path = user[8] if len(user) > 8 else None
         try:
-            # Создаем стандартную клавиатуру для профиля
-            buttons = [
-                [InlineKeyboardButton(text="История начислений", callback_data=f"history:{user[1]}")],
-                [InlineKeyboardButton(text="Обновить данные", callback_data="update_profile")]
-            ]
-            markup = InlineKeyboardMarkup(inline_keyboard=buttons)
-
-            if photo_path and os.path.exists(photo_path):
+            if callback.message.photo:
                 # Для сообщений с фото
-                await callback.message.edit_caption(caption=profile_text, reply_markup=markup)
+                await callback.message.edit_caption(caption=card.text, reply_markup=card.markup)
             else:
                 # Для текстовых сообщений
-                await callback.message.edit_text(profile_text, reply_markup=markup)
+                await edit_message_text(callback.message, card.text, reply_markup=card.markup)
 
             await callback.answer("Редактирование отменено")
         except Exception as e:
             logging.error(f"Error updating profile message: {e}")
             # Если не удалось отредактировать, отправляем новое сообщение
-            if photo_path and os.path.exists(photo_path):
-                await callback.message.answer_photo(FSInputFile(photo_path), caption=profile_text, reply_markup=markup)
-            else:
-                await callback.message.answer(profile_text, reply_markup=markup)
+            await send_profile_card(callback.message, card)
             await callback.message.delete()
 
     except Exception as e:
@@ -1493,12 +4235,14 @@ async def cancel_profile_update(callback: CallbackQuery, state: FSMContext):
 async def cleanup():
     """Закрытие соединений при выключении"""
     if conn:
+        audit_log.flush()
         conn.close()
         logging.info("Database connection closed")
 
 def get_invites_count(user_id):
-    cursor.execute("SELECT COUNT(*) FROM users WHERE invited_by = ?", (user_id,))
-    return cursor.fetchone()[0]
+    cursor.execute("SELECT invites_count FROM users WHERE user_id = ?", (user_id,))
+    result = cursor.fetchone()
+    return result[0] if result and result[0] else 0
 
 if __name__ == '__main__':
     try: